@@ -0,0 +1,331 @@
+"""
+Times the stages of the Catchment-CN preprocessing on a synthetic archive
+(see synthetic.py), so performance changes can be measured on any machine
+without access to the real GEOSldas output.
+
+Each stage is run `--repeat` times and written as one JSON line with wall and
+CPU time, throughput and peak traced allocation, plus the run metadata (commit,
+host, library versions, scale). `process_peak_rss_mb` is the peak RSS of the
+whole benchmark process up to the end of that record, not of the stage alone.
+With `--months` above 1, the `months` and `month_bands` stages regrid the later
+months with the weights built for the first, as the pipeline does. Compare
+against an earlier run (of the same scale) with --compare to flag slowdowns:
+
+    python run_benchmarks.py --tiles 200000 --out base.jsonl
+    python run_benchmarks.py --tiles 200000 --out new.jsonl --compare base.jsonl
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import xarray as xr
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(HERE))
+
+from catchcn_prep.config import DVMAP, VMAP
+from catchcn_prep.regrid import Regridder, apply_weights, calc_distances
+from catchcn_prep.times import time_encoding
+from catchcn_prep.variables import add_derived_variables, select_variables
+
+from synthetic import archive_month, make_archive
+
+STAGES = ['open_select','derived','mask','weights','apply','bands','griddata','encode','write','months','month_bands']
+SCALE = ('tiles','land_fraction','months','degout','precision','band_size')  # must match for --compare
+
+
+def run_metadata(args):
+    """
+    Where and on what the benchmark ran, so results from different runs can be compared.
+    """
+    try:
+        commit = subprocess.run(['git','-C',HERE,'rev-parse','--short','HEAD'],
+            capture_output=True,text=True,check=True
+        ).stdout.strip()
+    except (OSError,subprocess.CalledProcessError):
+        commit = None
+
+    import scipy
+    return {
+        'commit':commit,
+        'host':socket.gethostname(),
+        'platform':platform.platform(),
+        'python':platform.python_version(),
+        'numpy':np.__version__,
+        'xarray':xr.__version__,
+        'scipy':scipy.__version__,
+        'tiles':args.tiles,
+        'land_fraction':args.land_fraction,
+        'months':args.months,
+        'degout':args.degout,
+        'precision':args.precision,
+        'band_size':args.band_size,
+    }
+
+
+def measure(stage,fn,n,unit,repeat=1):
+    """
+    Runs `fn` `repeat` times and returns its result and one record per run:
+    wall and CPU seconds, `n` `unit`s per wall second, peak allocation traced
+    by tracemalloc (numpy arrays included) and the peak RSS of the whole process
+    so far (not just this stage).
+    """
+    records = []
+    for r in range(repeat):
+        tracemalloc.start()
+        wall,cpu = time.perf_counter(),time.process_time()
+        result = fn()
+        wall,cpu = time.perf_counter()-wall,time.process_time()-cpu
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        records.append({
+            'stage':stage,
+            'repeat':r,
+            'wall_s':wall,
+            'cpu_s':cpu,
+            'n':int(n),
+            'unit':unit,
+            'throughput':n/wall if wall > 0 else None,
+            'peak_alloc_mb':peak/2**20,
+            'process_peak_rss_mb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10,
+        })
+        print(f'├ {stage} ({r+1}/{repeat}): {wall:.3f}s wall, {cpu:.3f}s cpu, {peak/2**20:.1f} MB peak')
+    return result,records
+
+
+def run_benchmarks(args):
+    """
+    Runs the selected stages on the first synthetic month (the `months` stages on
+    the later ones) and returns the records.
+    """
+    root = args.root or tempfile.mkdtemp(prefix='catchcn_bench_')
+    print(f'\n• Synthetic archive: {root}')
+    infiles = make_archive(root,tiles=args.tiles,land_fraction=args.land_fraction,months=args.months,
+        extra_variables=args.extra_variables
+    )
+    infile = infiles[0]
+    outdir = tempfile.mkdtemp(prefix='catchcn_bench_out_')
+
+    # Import everything the stages use up front, so no stage pays for (or traces) an import
+    import cftime, netCDF4, scipy.interpolate, scipy.spatial, tqdm
+
+    regridder = Regridder(degout={'lat':args.degout[0],'lon':args.degout[1]},precision=args.precision,
+        band_size=args.band_size
+    )
+    target_lats,target_lons = regridder.target_grid(np.float64)   # as the pipeline: cast only the output
+    ngrid = len(target_lats)*len(target_lons)
+    stages = args.stages
+    records = []
+
+    def stage(name,fn,n,unit):
+        if name not in stages:
+            return None
+        result,rec = measure(name,fn,n,unit,args.repeat)
+        records.extend(rec)
+        return result
+
+    print(f'\n• Benchmarking {stages}')
+    def open_select(infile=infile):
+        with xr.open_dataset(infile,decode_timedelta=True) as raw:
+            return select_variables(raw,VMAP,args.precision).load()
+    df = stage('open_select',open_select,os.path.getsize(infile),'bytes')
+    if df is None:
+        df = open_select()
+    ntiles = df.sizes['tile']
+
+    df_derived = stage('derived',lambda: add_derived_variables(df,DVMAP),ntiles,'tiles')
+    df = df_derived if df_derived is not None else add_derived_variables(df,DVMAP)
+
+    model_lon,model_lat = df['lon'].values,df['lat'].values
+    model_points = np.column_stack((model_lon,model_lat))
+    if 'mask' in stages:
+        lon_grid,lat_grid = np.meshgrid(target_lons,target_lats)
+        target_points = np.column_stack((lon_grid.ravel(),lat_grid.ravel()))
+        del lon_grid,lat_grid
+        stage('mask',lambda: calc_distances(target_points,model_points),ngrid,'points')
+        del target_points
+
+    # Cold weights build every repeat; the cached copy is what the pipeline reuses
+    weights = stage('weights',
+        lambda: regridder.weights(model_lon,model_lat,target_lons,target_lats,cache=False),ngrid,'points')
+    if weights is None and ('apply' in stages or 'encode' in stages or 'write' in stages):
+        weights = regridder.weights(model_lon,model_lat,target_lons,target_lats,cache=False)
+
+    variables = [v for v in df.variables if not (('lat' in v) or ('lon' in v))]
+    def apply():
+        out = xr.Dataset(coords={'lon':(['lon'],target_lons.astype(args.precision)),
+            'lat':(['lat'],target_lats.astype(args.precision))})
+        for var in variables:
+            grid_values = apply_weights(weights,df[var].values.flatten())
+            out[var] = (['lat','lon'],grid_values.reshape(len(target_lats),len(target_lons)),df[var].attrs)
+        return out
+    df_regrid = stage('apply',apply,ngrid*len(variables),'points')
+
+    if 'bands' in stages:
+        stage('bands',lambda: regridder.regrid_to_file(df,os.path.join(outdir,'bands.nc'),2006,1),
+            ngrid*len(variables),'points')
+
+    if 'griddata' in stages:
+        # The original per-variable griddata regrid, for reference
+        from scipy.interpolate import griddata
+        lon_grid,lat_grid = np.meshgrid(target_lons,target_lats)
+        def reference():
+            return {var:griddata(model_points,df[var].values.flatten(),(lon_grid,lat_grid),method='linear')
+                for var in variables}
+        stage('griddata',reference,ngrid*len(variables),'points')
+        del lon_grid,lat_grid
+
+    if df_regrid is None and ('encode' in stages or 'write' in stages):
+        df_regrid = apply()
+    df_out = stage('encode',lambda: time_encoding(df_regrid,2006,1),ngrid*len(variables),'points')
+    if df_out is None and 'write' in stages:
+        df_out = time_encoding(df_regrid,2006,1)
+
+    fout = os.path.join(outdir,'catchcn_2006-01.nc')
+    def write():
+        df_out.to_netcdf(fout,format='NETCDF4')
+        return os.path.getsize(fout)
+    written = stage('write',write,0,'bytes')
+    if written is not None:
+        for rec in records:
+            if rec['stage'] == 'write':
+                rec['n'] = written
+                rec['throughput'] = written/rec['wall_s']
+
+    # Later months: read, derive, regrid and write with the weights of the first month
+    later = infiles[1:]
+    if later and 'months' in stages:
+        regridder.weights(model_lon,model_lat,target_lons,target_lats)
+        def months():
+            for i,f in enumerate(later,1):
+                df_month = regridder.regrid(add_derived_variables(open_select(f),DVMAP))
+                time_encoding(df_month,*archive_month(i)).to_netcdf(os.path.join(outdir,f'catchcn_month{i+1}.nc'),format='NETCDF4')
+        stage('months',months,ngrid*len(variables)*len(later),'points')
+    if later and 'month_bands' in stages:
+        # Band weights go through the on-disk cache, built here on the first month
+        cached = Regridder(degout=regridder.degout,precision=args.precision,band_size=args.band_size,
+            cache_dir=os.path.join(outdir,'regrid_cache')
+        )
+        cached.regrid_to_file(df,os.path.join(outdir,'bands_month1.nc'),2006,1)
+        def month_bands():
+            for i,f in enumerate(later,1):
+                cached.regrid_to_file(add_derived_variables(open_select(f),DVMAP),
+                    os.path.join(outdir,f'bands_month{i+1}.nc'),*archive_month(i))
+        stage('month_bands',month_bands,ngrid*len(variables)*len(later),'points')
+
+    return records
+
+
+def compare(records,baseline,threshold):
+    """
+    Compares the median wall time per stage against a baseline JSONL file.
+    Returns the stages that got slower by more than `threshold` (a fraction).
+    Raises ValueError if the baseline ran at a different scale (see SCALE).
+    """
+    def medians(recs):
+        by_stage = {}
+        for rec in recs:
+            by_stage.setdefault(rec['stage'],[]).append(rec['wall_s'])
+        return {s:float(np.median(w)) for s,w in by_stage.items()}
+
+    with open(baseline) as f:
+        base = [json.loads(line) for line in f if line.strip()]
+    meta = {k:base[0].get(k) for k in SCALE if k in base[0]} if base else {}
+    differ = [f'{k} {v} (now {records[0].get(k)})' for k,v in meta.items() if records and records[0].get(k) != v]
+    if differ:
+        raise ValueError(f'Baseline {baseline} ran with different settings: {", ".join(differ)}')
+    now,before = medians(records),medians(base)
+
+    print(f'\n• Comparing against {baseline} ({meta})')
+    slower = []
+    for s in now:
+        if s not in before:
+            continue
+        ratio = now[s]/before[s] if before[s] > 0 else np.inf
+        flag = ratio > 1+threshold
+        print(f'├ {s}: {before[s]:.3f}s -> {now[s]:.3f}s ({ratio:.2f}x){"  !! slower" if flag else ""}')
+        if flag:
+            slower.append(s)
+    return slower
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Catchment-CN preprocessing stages on synthetic data.')
+    parser.add_argument('--root',type=str,default=None,
+        help='Directory for the synthetic archive (reused between runs). Default: a new temporary directory'
+    )
+    parser.add_argument('--tiles',type=int,default=100000,
+        help='Approximate number of land tiles. Default: %(default)s'
+    )
+    parser.add_argument('--land_fraction',type=float,default=0.27,
+        help='Fraction of grid cells that are land tiles. Default: %(default)s'
+    )
+    parser.add_argument('--months',type=int,default=1,
+        help='Monthly files to write; months after the first are regridded by the months and '
+            'month_bands stages, reusing the first month\'s weights. Default: %(default)s'
+    )
+    parser.add_argument('--extra_variables',type=int,default=20,
+        help='Filler variables per input file. Default: %(default)s'
+    )
+    parser.add_argument('--degout',type=float,nargs=2,default=[0.5,0.5],metavar=('LAT','LON'),
+        help='Target grid spacing in degrees. Default: %(default)s'
+    )
+    parser.add_argument('--precision',choices=['float64','float32'],default='float64',
+        help='Working precision. Default: %(default)s'
+    )
+    parser.add_argument('--band_size',type=float,default=10,
+        help='Band size in degrees for the bands stage. Default: %(default)s'
+    )
+    parser.add_argument('--stages',type=str,nargs='+',choices=STAGES,
+        default=[s for s in STAGES if s != 'griddata'],
+        help='Stages to run; griddata (the slow reference regrid) is off by default, '
+            'and months/month_bands only run with --months above 1.'
+    )
+    parser.add_argument('--repeat',type=int,default=3,
+        help='Runs per stage. Default: %(default)s'
+    )
+    parser.add_argument('--out',type=str,default=None,
+        help='JSON lines file to append the results to.'
+    )
+    parser.add_argument('--compare',type=str,default=None,
+        help='Baseline JSON lines file from an earlier run; exits 1 if a stage got slower than --threshold.'
+    )
+    parser.add_argument('--threshold',type=float,default=0.2,
+        help='Allowed fractional slowdown per stage for --compare. Default: %(default)s'
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    meta = run_metadata(args)
+    records = [{**meta,**rec} for rec in run_benchmarks(args)]
+
+    if args.out:
+        with open(args.out,'a') as f:
+            for rec in records:
+                f.write(json.dumps(rec)+'\n')
+        print(f'\nWrote {len(records)} records to {args.out}')
+
+    if args.compare:
+        try:
+            slower = compare(records,args.compare,args.threshold)
+        except ValueError as e:
+            print(f'\n!!==> {e}; not comparing')
+            sys.exit(1)
+        if slower:
+            print(f'\n!!==> Slower than baseline by more than {args.threshold:.0%}: {", ".join(slower)}')
+            sys.exit(1)
+
+
+if __name__=='__main__':
+    main()
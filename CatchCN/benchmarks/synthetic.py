@@ -0,0 +1,142 @@
+"""
+Synthetic GEOSldas Catchment-CN tile files for benchmarking, laid out like the
+/css/gmao archive (<root>/ens0000/Y2006/M01/GEOSldas_CN40_9km.tavg24_1d_lnd_Nt.monthly.200601.nc4)
+so the preprocessing can run on them unchanged.
+
+Tiles sit on the centres of an EASE-Grid 2.0-like global cylindrical equal-area
+grid (3856 x 1624 cells at M09), scaled down so that `land_fraction` of its
+cells give `tiles` land tiles. The land mask is a smooth random field, so the
+tiles form continents and coastlines rather than scattered points.
+
+    python synthetic.py --root /tmp/synthetic --tiles 200000 --months 3
+"""
+import argparse
+import os
+
+import numpy as np
+import xarray as xr
+
+# EASE-Grid 2.0 global M09: columns x rows, and the latitude limit of the grid
+EASE_M09_SHAPE = (3856,1624)
+EASE_MAX_LAT = 85.044
+
+CATCHCN_VARIABLES = ['CNNPP','CNGPP','CNSR','LAI']
+FILE_PREFIX = 'GEOSldas_CN40_9km.tavg24_1d_lnd_Nt'
+
+
+def ease_like_tiles(tiles,land_fraction=0.27,seed=0):
+    """ 
+    Lon/lat of roughly `tiles` land tiles on a scaled EASE-like grid.
+    Returns float32 arrays, ordered row by row like the real tile space.
+    """
+    rng = np.random.default_rng(seed)
+    ncells = tiles/land_fraction
+    ncol0,nrow0 = EASE_M09_SHAPE
+    nrow = max(2,int(round(np.sqrt(ncells*nrow0/ncol0))))
+    ncol = max(2,int(round(ncells/nrow)))
+
+    # Equal-area rows: evenly spaced in sin(lat)
+    lon = -180+(np.arange(ncol)+0.5)*360/ncol
+    smax = np.sin(np.deg2rad(EASE_MAX_LAT))
+    lat = np.rad2deg(np.arcsin(smax*(1-2*(np.arange(nrow)+0.5)/nrow)))
+    lon2d,lat2d = np.meshgrid(lon,lat)
+
+    # Smooth random field -> continents; threshold to the requested land fraction
+    field = np.zeros(lon2d.shape)
+    lam,phi = np.deg2rad(lon2d),np.deg2rad(lat2d)
+    for k in range(1,7):
+        a,b,c,d = rng.normal(size=4)
+        field += (a*np.sin(k*lam+b)*np.cos(k*phi+c)+0.3*d*np.cos((k+1)*phi))/k
+    field += 0.05*rng.normal(size=field.shape)
+    land = field > np.quantile(field,1-land_fraction)
+
+    return lon2d[land].astype(np.float32),lat2d[land].astype(np.float32)
+
+
+def tile_dataset(lon,lat,year,month,extra_variables=0,seed=0):
+    """ 
+    One month of synthetic tile output: the CatchCN carbon variables with a
+    plausible seasonal cycle, plus `extra_variables` filler variables that the
+    preprocessing will drop (the real files carry ~70 of them).
+    """
+    rng = np.random.default_rng(seed+year*12+month)
+    season = 1+0.5*np.sin(2*np.pi*(month-4)/12)*np.sign(lat)
+    base = 3e-8*np.cos(np.deg2rad(lat))*season*(1+0.1*rng.random(lat.size))
+
+    values = {
+        'CNGPP':base,
+        'CNNPP':0.45*base,
+        'CNSR':0.85*base,
+        'LAI':4*np.cos(np.deg2rad(lat))*season,
+    }
+    units = {'CNGPP':'kg m-2 s-1','CNNPP':'kg m-2 s-1','CNSR':'kg m-2 s-1','LAI':'1'}
+
+    df = xr.Dataset(coords={'time':[np.datetime64(f'{year:0>4}-{month:0>2}-01')]})
+    for v in CATCHCN_VARIABLES:
+        df[v] = (('time','tile'),values[v][np.newaxis].astype(np.float32),{'units':units[v]})
+    for i in range(extra_variables):
+        df[f'EXTRA{i:02}'] = (('time','tile'),rng.random((1,lat.size),dtype=np.float32))
+    df['lon'] = (('tile',),lon,{'units':'degrees_east'})
+    df['lat'] = (('tile',),lat,{'units':'degrees_north'})
+
+    return df
+
+
+def archive_month(i,start_year=2006):
+    """ 
+    (year,month) of the `i`th (from 0) monthly file of an archive starting in January `start_year`.
+    """
+    return start_year+i//12,i%12+1
+
+
+def make_archive(root,tiles=100000,land_fraction=0.27,months=2,start_year=2006,
+        extra_variables=20,members=1,seed=0):
+    """ 
+    Writes `months` monthly files (from January `start_year`) for each of `members`
+    ensemble members under `root`, reusing existing files.
+    Returns the list of files written for member 0.
+    """
+    lon,lat = ease_like_tiles(tiles,land_fraction,seed)
+    files = []
+    for member in range(members):
+        for i in range(months):
+            year,month = archive_month(i,start_year)
+            d = os.path.join(root,f'ens{member:0>4}',f'Y{year:0>4}',f'M{month:0>2}')
+            f = os.path.join(d,f'{FILE_PREFIX}.monthly.{year:0>4}{month:0>2}.nc4')
+            if not os.path.exists(f):
+                os.makedirs(d,exist_ok=True)
+                tile_dataset(lon,lat,year,month,extra_variables,seed+member).to_netcdf(f,format='NETCDF4')
+            if member == 0:
+                files.append(f)
+    return files
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Write a synthetic Catchment-CN tile archive.')
+    parser.add_argument('--root',type=str,required=True,
+        help='Directory to write the archive under (ens0000/Y..../M..)'
+    )
+    parser.add_argument('--tiles',type=int,default=100000,
+        help='Approximate number of land tiles. The real M09 archive has ~1.6M. Default: %(default)s'
+    )
+    parser.add_argument('--land_fraction',type=float,default=0.27,
+        help='Fraction of grid cells that are land tiles. Default: %(default)s'
+    )
+    parser.add_argument('--months',type=int,default=2,
+        help='Number of monthly files per member. Default: %(default)s'
+    )
+    parser.add_argument('--extra_variables',type=int,default=20,
+        help='Filler variables per file, dropped by the preprocessing. Default: %(default)s'
+    )
+    parser.add_argument('--members',type=int,default=1,
+        help='Number of ensemble members. Default: %(default)s'
+    )
+    return parser.parse_args()
+
+
+if __name__=='__main__':
+    args = parse_args()
+    files = make_archive(args.root,args.tiles,args.land_fraction,args.months,
+        extra_variables=args.extra_variables,members=args.members
+    )
+    print(f'Wrote {len(files)} monthly files per member under {args.root}')
@@ -0,0 +1,47 @@
+"""
+Catchment-CN -> ILAMB preprocessing as an importable package.
+
+    from catchcn_prep import Config, Pipeline
+    config = Config(indir='.../cat/ens0000/',outdir='.../out/',
+        filetype='lnd_Nt.monthly',years=(2006,2010))
+    Pipeline(config).run()
+
+A `Regridder` can be built once and passed to several Pipelines (or called
+directly with `Regridder.regrid(df)`) to reuse its interpolation weights.
+
+Submodules, and with them xarray/scipy/etc., are only imported when one of
+the names below is first used.
+"""
+import importlib
+
+_exports = {
+    'Config':'config',
+    'VMAP':'config',
+    'DVMAP':'config',
+    'Pipeline':'pipeline',
+    'Metrics':'metrics',
+    'plan':'plan',
+    'Regridder':'regrid',
+    'apply_weights':'regrid',
+    'calc_distances':'regrid',
+    'variable_preprocessing':'variables',
+    'reduce_daily':'variables',
+    'native_tile_layout':'layout',
+    'time_encoding':'times',
+    'spot_check':'spotcheck',
+    'rasterize':'spotcheck',
+    'read_sites':'sites',
+    'resolve_sites':'sites',
+    'sample_sites':'sites',
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name in _exports:
+        module = importlib.import_module(f'.{_exports[name]}',__name__)
+        value = getattr(module,name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,207 @@
+"""
+Streaming temporal aggregation: annual means and the monthly climatology
+(mean and interannual variance) are built with running accumulators as each
+regridded month goes by, so memory doesn't grow with the length of the record:
+two grids per variable for the annual mean, and a mean and sum of squares per
+variable for each calendar month in the climatology (plus small integer counts).
+"""
+import os
+
+import numpy as np
+import xarray as xr
+
+from .layout import spatial_coords, spatial_field
+from .times import aggregate_time_encoding, month_days, next_month
+
+
+def aggregate_prefix(infile):
+    """ 
+    Strips the date stamp off a monthly filename, e.g.
+    GEOSldas_CN40_9km.tavg24_1d_lnd_Nt.monthly.200601.nc4 -> GEOSldas_CN40_9km.tavg24_1d_lnd_Nt
+    """
+    base = os.path.basename(infile).replace('.nc4','')
+    return base.split('.monthly')[0]
+
+
+def init_aggregates(kinds,outdir,suffix):
+    """ 
+    Sets up the (empty) running accumulators.
+    `kinds` is any combination of 'annual' and 'climatology'.
+    """
+    return {
+        'kinds':kinds,
+        'outdir':outdir,
+        'suffix':suffix,
+        'prefix':None,      # filled in from the first input file
+        'coords':None,      # lat/lon of the output grid (or tiles)
+        'dims':{},          # spatial dimensions of each variable
+        'attrs':{},         # variable attributes to carry over
+        'year':None,        # year currently being accumulated
+        'months':[],        # months seen so far in that year
+        'annual':{},        # var -> [sum(w*x), sum(w) in days]
+        'clim':{},          # var -> 12 slots of {'n','mean','m2'}
+        'clim_years':None,  # [first,last] year in the climatology
+    }
+
+
+def update_aggregates(agg,df,year,month):
+    """ 
+    Folds one regridded month into the running accumulators.
+    Each month is weighted by its length in days, and NaNs (ocean, missing data)
+    are left out cell by cell.
+    The climatology uses a Welford update so the variance comes out of a single
+    pass. A calendar month has the same length every (noleap) year, so its
+    weights are all equal and a per-cell count of years is enough.
+    """
+    w = month_days(df)
+
+    if agg['coords'] is None:
+        agg['coords'] = spatial_coords(df)
+
+    # A new year means the previous annual mean is complete
+    if 'annual' in agg['kinds']:
+        if agg['year'] is not None and year != agg['year']:
+            write_annual(agg)
+        agg['year'] = year
+        agg['months'].append(month)
+
+    if 'climatology' in agg['kinds']:
+        if agg['clim_years'] is None:
+            agg['clim_years'] = [year,year]
+        agg['clim_years'] = [min(agg['clim_years'][0],year),max(agg['clim_years'][1],year)]
+
+    for var in df.data_vars:
+        if var == 'time_bnds':
+            continue
+        agg['attrs'].setdefault(var,dict(df[var].attrs))
+        field = spatial_field(df[var])
+        agg['dims'].setdefault(var,field.dims)
+        x = field.values
+        valid = np.isfinite(x)
+        x = np.where(valid,x,0)
+
+        if 'annual' in agg['kinds']:
+            if var not in agg['annual']:
+                agg['annual'][var] = [np.zeros(x.shape,dtype=x.dtype),np.zeros(x.shape,dtype=np.uint16)]
+            s,ws = agg['annual'][var]
+            s += w*x
+            ws += np.uint16(w)*valid
+
+        if 'climatology' in agg['kinds']:
+            slots = agg['clim'].setdefault(var,[None]*12)
+            if slots[month-1] is None:
+                slots[month-1] = {'n':np.zeros(x.shape,dtype=np.uint16),
+                    'mean':np.zeros(x.shape,dtype=x.dtype),'m2':np.zeros(x.shape,dtype=x.dtype)}
+            acc = slots[month-1]
+            acc['n'] += valid
+            delta = x-acc['mean']
+            acc['mean'] += np.divide(delta,acc['n'],out=np.zeros(x.shape,dtype=x.dtype),where=valid)
+            acc['m2'] += np.where(valid,delta*(x-acc['mean']),0)
+
+
+def write_annual(agg):
+    """ 
+    Writes the annual mean for the year currently held in `agg`
+    and resets the annual accumulators.
+    """
+    import cftime as cf
+
+    year = agg['year']
+    months = sorted(agg['months'])
+    fout = f"{agg['outdir']}{agg['prefix']}.annual.{year}{agg['suffix']}.nc"
+
+    df = xr.Dataset(coords=agg['coords'])
+    for var,(s,ws) in agg['annual'].items():
+        mean = np.divide(s,ws,out=np.full(s.shape,np.nan,dtype=s.dtype),where=ws>0)
+        df[var] = (('time',)+agg['dims'][var],mean[np.newaxis])
+        df[var].attrs = dict(agg['attrs'][var])
+        df[var].attrs['cell_methods'] = 'time: mean'
+
+    # Stamped at the start of the first month averaged, like the monthly files
+    nyear,nmonth = next_month(year,months[-1])
+    df = aggregate_time_encoding(df,
+        [cf.DatetimeNoLeap(year,months[0],1,0,0,0)],
+        [[cf.DatetimeNoLeap(year,months[0],1,0,0,0),cf.DatetimeNoLeap(nyear,nmonth,1,0,0,0)]]
+    )
+    df.attrs['n_months'] = len(months)
+
+    print(f'Writing annual mean {fout}')
+    df.to_netcdf(fout,format='NETCDF4')
+
+    agg['annual'] = {}
+    agg['months'] = []
+
+
+def write_climatology(agg):
+    """ 
+    Writes the monthly climatology (mean and sample variance across years, NaN
+    with fewer than two years, as for the ensemble spread) for every
+    calendar month that was accumulated. The file is laid out first and then
+    filled one variable and month at a time, freeing each accumulator as it
+    goes, so writing never needs more than one extra grid.
+    """
+    import cftime as cf
+    import netCDF4
+
+    y0,y1 = agg['clim_years']
+    fout = f"{agg['outdir']}{agg['prefix']}.climatology.{y0}-{y1}{agg['suffix']}.nc"
+
+    first = next(iter(agg['clim'].values()))
+    months = [m+1 for m,acc in enumerate(first) if acc is not None]
+
+    bounds = []
+    for m in months:
+        nyear,nmonth = next_month(y1,m)
+        bounds.append([cf.DatetimeNoLeap(y0,m,1,0,0,0),cf.DatetimeNoLeap(nyear,nmonth,1,0,0,0)])
+    skeleton = aggregate_time_encoding(xr.Dataset(coords=agg['coords']),
+        [cf.DatetimeNoLeap(y0,m,1,0,0,0) for m in months],
+        bounds,
+        climatology=True
+    )
+    print(f'Writing monthly climatology {fout}')
+    skeleton.to_netcdf(fout,format='NETCDF4')
+    del skeleton
+
+    with netCDF4.Dataset(fout,'a') as nc:
+        for var,slots in agg['clim'].items():
+            dtype = slots[months[0]-1]['mean'].dtype
+            dims = ('time',)+agg['dims'][var]
+
+            attrs = dict(agg['attrs'][var])
+            attrs['cell_methods'] = 'time: mean within years time: mean over years'
+            ncmean = nc.createVariable(var,dtype,dims,fill_value=np.nan)
+            ncmean.setncatts(attrs)
+
+            attrs = dict(agg['attrs'][var])
+            if 'long_name' in attrs:
+                attrs['long_name'] += '_interannual_variance'
+            if 'units' in attrs:
+                attrs['units'] = f"({attrs['units']})2"
+            attrs['cell_methods'] = 'time: mean within years time: variance over years'
+            attrs['comment'] = 'sample variance (divided by years-1); NaN with fewer than 2 years'
+            ncvar = nc.createVariable(var+'_variance',dtype,dims,fill_value=np.nan)
+            ncvar.setncatts(attrs)
+
+            for t,m in enumerate(months):
+                acc = slots[m-1]
+                # Finalise in place: mean, NaN where no year had a value, and
+                # m2/(n-1), NaN where fewer than two years had one
+                empty = acc['n'] == 0
+                acc['mean'][empty] = np.nan
+                ncmean[t] = acc['mean']
+                few = acc['n'] < 2
+                np.divide(acc['m2'],acc['n']-1,out=acc['m2'],where=~few)
+                acc['m2'][few] = np.nan
+                ncvar[t] = acc['m2']
+                slots[m-1] = None
+    agg['clim'] = {}
+
+
+def finalize_aggregates(agg):
+    """ 
+    Writes out whatever is still sitting in the accumulators at the end of the run.
+    """
+    if 'annual' in agg['kinds'] and agg['annual']:
+        write_annual(agg)
+    if 'climatology' in agg['kinds'] and agg['clim']:
+        write_climatology(agg)
@@ -0,0 +1,276 @@
+"""
+Regrid backends: interchangeable ways of interpolating tile values onto the
+target grid. Each backend does its per-geometry work (ocean mask,
+triangulation, weights) once when it's built and then interpolates any number
+of variables with `interpolate()`.
+
+    griddata            scipy griddata(method='linear') per variable (the original method)
+    weights             cached sparse Delaunay weights, identical to griddata (the default)
+    xesmf_bilinear      xESMF bilinear from the tiles' native lat/lon lattice (untested)
+    xesmf_conservative  xESMF first-order conservative from the same lattice (untested)
+
+xESMF can't interpolate bilinearly or conservatively from a LocStream (a bare
+list of points) - it only does nearest-neighbour from one - so the xESMF backends
+first place the tiles back on the rectilinear lattice they come from (EASE-Grid
+2.0 rows and columns) and regrid that, with the ocean as missing values.
+All backends share the Regridder's ocean mask, so their outputs only differ
+inside the land.
+
+Only BACKENDS (config.py) can be picked on the command line. The xESMF backends
+have not been run with xESMF installed yet, so they are only reachable from
+Python (Regridder(backend=...)) until they have been checked on real tiles.
+
+`choose_backend()` implements --regrid_backend auto: time each of BACKENDS
+on a latitude band of the actual tiles, check it against griddata, and take
+the fastest that's within tolerance. As griddata and weights give the same
+numbers, that is weights; auto is kept so the xESMF backends can join the
+calibration once they are tested.
+"""
+import os
+import time
+
+import numpy as np
+
+from .config import BACKENDS
+from .metrics import Metrics
+
+class RegridBackend:
+    """
+    Interpolates tile values (`model_lon`,`model_lat`) onto the points of the
+    (`target_lons`,`target_lats`) grid, flattened lat-major. Masked target
+    points come back as NaN. `wfile` is a file to save/reuse per-geometry work in.
+    """
+    name = None
+
+    def __init__(self,regridder,model_lon,model_lat,target_lons,target_lats,wfile=None,cache=True):
+        self.regridder = regridder
+        self.precision = regridder.precision
+        self.shape = (len(target_lats),len(target_lons))
+
+    def interpolate(self,values):
+        raise NotImplementedError
+
+
+class GriddataBackend(RegridBackend):
+    """
+    scipy griddata(method='linear') for every variable, then the ocean mask.
+    Re-triangulates on every call, so it only pays off for a single variable.
+    """
+    name = 'griddata'
+
+    def __init__(self,regridder,model_lon,model_lat,target_lons,target_lats,wfile=None,cache=True):
+        super().__init__(regridder,model_lon,model_lat,target_lons,target_lats,wfile,cache)
+        lon_grid,lat_grid = np.meshgrid(target_lons,target_lats)
+        self.model_points = np.column_stack((model_lon,model_lat))
+        self.target_points = np.column_stack((lon_grid.ravel(),lat_grid.ravel()))
+        del lon_grid,lat_grid
+        self.ocean_mask = regridder.ocean_mask(self.model_points,self.target_points)
+
+    def interpolate(self,values):
+        from scipy.interpolate import griddata
+
+        out = griddata(self.model_points,values,self.target_points,method='linear')
+        out[self.ocean_mask] = np.nan
+        return out.astype(self.precision)
+
+
+class WeightsBackend(RegridBackend):
+    """
+    Sparse Delaunay weights from `Regridder.weights()`: the same answer as
+    griddata, but the triangulation is done once per geometry (and can be
+    shared between jobs through `wfile`).
+    """
+    name = 'weights'
+
+    def __init__(self,regridder,model_lon,model_lat,target_lons,target_lats,wfile=None,cache=True):
+        super().__init__(regridder,model_lon,model_lat,target_lons,target_lats,wfile,cache)
+        self.weights = regridder.weights(model_lon,model_lat,target_lons,target_lats,wfile=wfile,cache=cache)
+
+    def interpolate(self,values):
+        from .regrid import apply_weights
+
+        return apply_weights(self.weights,values)
+
+
+class XesmfBackend(RegridBackend):
+    """
+    xESMF `method` regridding from the tiles' native lattice (see `tile_lattice()`).
+    Target cells for the conservative method run from each grid point (the lower-left
+    corner) to the next, matching how the output grid is labelled.
+    """
+    method = None
+
+    def __init__(self,regridder,model_lon,model_lat,target_lons,target_lats,wfile=None,cache=True):
+        super().__init__(regridder,model_lon,model_lat,target_lons,target_lats,wfile,cache)
+        try:
+            import xesmf as xe
+        except ImportError:
+            raise ValueError(f'The {self.name} regrid backend needs xESMF (conda install -c conda-forge xesmf)')
+        import xarray as xr
+
+        lats,lons,self.row,self.col = tile_lattice(model_lon,model_lat)
+        grid_in = xr.Dataset(coords={
+            'lat':(['lat'],lats),'lon':(['lon'],lons),
+            'lat_b':(['lat_b'],cell_edges(lats,-90,90)),'lon_b':(['lon_b'],cell_edges(lons,-180,180)),
+        })
+        dlat,dlon = regridder.degout['lat'],regridder.degout['lon']
+        grid_out = xr.Dataset(coords={
+            'lat':(['lat'],target_lats),'lon':(['lon'],target_lons),
+            'lat_b':(['lat_b'],np.clip(np.append(target_lats,target_lats[-1]+dlat),-90,90)),
+            'lon_b':(['lon_b'],np.append(target_lons,target_lons[-1]+dlon)),
+        })
+
+        # Same ocean mask as the other backends
+        lon_grid,lat_grid = np.meshgrid(target_lons,target_lats)
+        self.ocean_mask = regridder.ocean_mask(np.column_stack((model_lon,model_lat)),
+            np.column_stack((lon_grid.ravel(),lat_grid.ravel())))
+        del lon_grid,lat_grid
+
+        with regridder.metrics.stage('weights',n=self.ocean_mask.size,unit='points'):
+            start = time.time()
+            periodic = self.method == 'bilinear'
+            if wfile and os.path.exists(wfile):
+                if regridder.verbose:
+                    print(f'\n• Loading xESMF {self.method} weights from {wfile}')
+                self.xe_regridder = xe.Regridder(grid_in,grid_out,self.method,periodic=periodic,weights=wfile)
+            else:
+                print(f'\n• Building xESMF {self.method} weights from a {len(lats)}x{len(lons)} tile lattice')
+                self.xe_regridder = xe.Regridder(grid_in,grid_out,self.method,periodic=periodic)
+                if wfile:
+                    print(f'Saving xESMF weights to {wfile}')
+                    self.xe_regridder.to_netcdf(wfile)
+            print(f'⧖ Building regrid weights took {time.time()-start:.2f} seconds')
+        self.lattice_shape = (len(lats),len(lons))
+
+    def interpolate(self,values):
+        lattice = np.full(self.lattice_shape,np.nan)
+        lattice[self.row,self.col] = values
+        # skipna renormalises by the land fraction of each target point's stencil,
+        # so coastal points aren't dragged towards zero by the ocean
+        out = np.asarray(self.xe_regridder(lattice,skipna=True,na_thres=1.0)).ravel()
+        out[self.ocean_mask] = np.nan
+        return out.astype(self.precision)
+
+
+class XesmfBilinearBackend(XesmfBackend):
+    name = 'xesmf_bilinear'
+    method = 'bilinear'
+
+
+class XesmfConservativeBackend(XesmfBackend):
+    name = 'xesmf_conservative'
+    method = 'conservative'
+
+
+BACKEND_CLASSES = {cls.name:cls for cls in
+    (GriddataBackend,WeightsBackend,XesmfBilinearBackend,XesmfConservativeBackend)}
+
+
+def tile_lattice(model_lon,model_lat,decimals=4,max_cells_per_tile=20):
+    """
+    Rebuilds the rectilinear lattice the tiles sit on (EASE-Grid 2.0 tiles have one
+    latitude per row and one longitude per column): its sorted latitudes and
+    longitudes, and each tile's row and column. Land is ~1/4 of the M09 lattice;
+    if the tiles fill much less of it than that they aren't on a lattice at all,
+    and if two tiles round to the same cell one of them would be lost.
+    """
+    lats,row = np.unique(np.round(model_lat.astype(np.float64),decimals),return_inverse=True)
+    lons,col = np.unique(np.round(model_lon.astype(np.float64),decimals),return_inverse=True)
+    if len(lats)*len(lons) > max_cells_per_tile*len(model_lat):
+        raise ValueError(f'Tiles do not lie on a rectilinear lat/lon lattice ({len(lats)} latitudes x '
+            f'{len(lons)} longitudes); use the griddata or weights regrid backend')
+    cells = row.ravel().astype(np.int64)*len(lons)+col.ravel()
+    shared = len(cells)-len(np.unique(cells))
+    if shared:
+        raise ValueError(f'{shared:,} tiles share a lattice cell with another tile at {decimals} decimals; '
+            'use the griddata or weights regrid backend')
+    return lats,lons,row,col
+
+
+def cell_edges(centres,lo,hi):
+    """
+    Cell edges half way between `centres`, extrapolated at the ends and clipped to [lo,hi].
+    """
+    if len(centres) == 1:
+        return np.array([lo,hi],dtype=np.float64)
+    mid = (centres[1:]+centres[:-1])/2
+    edges = np.concatenate(([2*centres[0]-mid[0]],mid,[2*centres[-1]-mid[-1]]))
+    return np.clip(edges,lo,hi)
+
+
+def compare_fields(x,ref):
+    """
+    Largest absolute difference between `x` and the reference `ref`, relative to the largest
+    reference value, and the fraction of reference points whose masking differs.
+    """
+    both = np.isfinite(x) & np.isfinite(ref)
+    scale = np.nanmax(np.abs(ref)) if np.isfinite(ref).any() else np.nan
+    maxdiff = np.max(np.abs(x[both].astype(np.float64)-ref[both])) if both.any() else 0.0
+    masked = np.count_nonzero(np.isnan(x) != np.isnan(ref))/max(1,np.count_nonzero(np.isfinite(ref)))
+    # An all-zero (or all-masked) reference has no scale; fall back to the absolute difference
+    return (maxdiff/scale if scale > 0 else maxdiff),masked
+
+
+def choose_backend(regridder,model_lon,model_lat,target_lons,target_lats,values,nvars=1,
+        tolerance=1e-3,band=10.0,nfiles=1):
+    """
+    Calibrates BACKENDS (griddata first: it's the reference) on a `band`-degree latitude band of the actual tiles
+    (centred on the median tile latitude) and returns the fastest whose relative
+    error against griddata and masking mismatch are both within `tolerance`,
+    with the timings and errors that decided it.
+    Cost is what one file of `nvars` variables would take when the backend is
+    built once for the `nfiles` files of the run: build/nfiles + nvars x interpolate.
+    The calibration is recorded as one 'calibrate' metrics stage; the mask and
+    weights builds inside it aren't recorded separately.
+    """
+    from scipy.spatial import QhullError
+
+    centre = float(np.median(model_lat))
+    rows = (target_lats >= centre-band/2) & (target_lats < centre+band/2)
+    if not rows.any():
+        rows[np.argmin(np.abs(target_lats-centre))] = True
+    band_lats = target_lats[rows]
+    halo = regridder.band_halo
+    sub = np.flatnonzero((model_lat >= band_lats[0]-halo) & (model_lat <= band_lats[-1]+halo))
+    scale = len(target_lats)/len(band_lats)
+
+    print(f'\n• Calibrating regrid backends on {len(sub):,} tiles between {band_lats[0]:.1f} and {band_lats[-1]:.1f} degrees')
+    results = {}
+    reference = None
+    # Keep the calibration builds out of the mask/weights rows, which the planner fits per file
+    metrics,regridder.metrics = regridder.metrics,Metrics()
+    try:
+        with metrics.stage('calibrate',n=len(sub),unit='tiles'):
+            for name in BACKENDS:
+                try:
+                    start = time.time()
+                    backend = BACKEND_CLASSES[name](regridder,model_lon[sub],model_lat[sub],target_lons,band_lats,cache=False)
+                    build = time.time()-start
+                    start = time.time()
+                    out = backend.interpolate(values[sub])
+                    apply = time.time()-start
+                except (ValueError,QhullError) as e:
+                    # e.g. too few tiles in the band to triangulate
+                    print(f'├ {name}: skipped ({e})')
+                    if name == 'griddata':
+                        raise ValueError(f'Could not calibrate the regrid backends: griddata, the reference, '
+                            f'failed on the calibration band ({e}); choose --regrid_backend explicitly')
+                    continue
+                if reference is None:
+                    reference = out     # griddata comes first
+                error,masked = compare_fields(out,reference)
+                cost = scale*(build/max(1,nfiles)+nvars*apply)
+                results[name] = {'build_s':build,'apply_s':apply,'estimated_s':cost,'error':error,'mask_mismatch':masked}
+                print(f'├ {name}: build {build:.2f}s, apply {apply:.3f}s/variable, est. {cost:.1f}s per file '
+                    f'over {nfiles} files, error {error:.1e}, mask mismatch {masked:.1e}')
+                del backend
+    finally:
+        regridder.metrics = metrics
+
+    ok = [n for n,r in results.items() if r['error'] <= tolerance and r['mask_mismatch'] <= tolerance]
+    if not ok:
+        print(f'!!==> No regrid backend within tolerance {tolerance:g} of griddata; using griddata')
+        return 'griddata',results
+    choice = min(ok,key=lambda n: results[n]['estimated_s'])
+    print(f'• Using the {choice} regrid backend (fastest within tolerance {tolerance:g})')
+    return choice,results
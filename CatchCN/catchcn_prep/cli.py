@@ -0,0 +1,244 @@
+"""
+Command-line interface. Only argparse and the Config are imported up front,
+so --help (and argument errors) come back immediately; the compute modules
+are imported once there is work to do.
+"""
+import argparse
+import dataclasses
+import sys
+
+from .config import BACKENDS, DEGOUT, Config
+from .metrics import STAGES
+
+
+########################
+#   Argument parser
+########################
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Preprocess GEOSldas Catchment-CN output for ILAMB.'
+    )
+
+    parser.add_argument('--indir',type=str,
+        help='Input directory'
+    )
+    parser.add_argument('--outdir',type=str,
+        help='Output directory'
+    )
+    parser.add_argument('--filetype',type=str,
+        default='*',
+        help='File type, a substring to use when doing a glob search.'
+    )
+    parser.add_argument('--years',nargs=2,type=int,
+        metavar=('Start','End'),
+        help='Start and end years, inclusive. e.g. --years 2020 2025'
+    )
+    parser.add_argument('--months',nargs=2,type=int,default=[1,12],
+        metavar=('Start','End'),
+        help='Start and end months, inclusive. Defaults: %(default)s. e.g. --months 1 12'
+    )
+    parser.add_argument('--suffix',type=str,
+        default='-ILAMB',
+        help='Suffix to add to filename when writing out changes.'
+    )
+    parser.add_argument('--aggregate',nargs='+',
+        choices=['annual','climatology'],
+        help='Also write streaming temporal aggregates of the regridded output: '
+            'annual means and/or monthly climatology (mean and variance). '
+            'e.g. --aggregate annual climatology'
+    )
+    parser.add_argument('--daily',
+        action='store_true',
+        help='Read daily files (e.g. --filetype tavg24_1d_lnd_Nt) and reduce them to monthly means '
+            'in native tile space before preprocessing and regridding.'
+    )
+    parser.add_argument('--daily_extremes',
+        action='store_true',
+        help='With --daily, also write the monthly maximum and minimum of the daily values.'
+    )
+    parser.add_argument('--allow_missing_days',
+        action='store_true',
+        help='With --daily, average a month that has fewer (or more) daily files than days instead '
+            'of stopping. The output is in the noleap calendar, so 29 February is always left out.'
+    )
+    parser.add_argument('--members',nargs='+',type=int,
+        metavar='N',
+        help='Ensemble members to process in one job, e.g. --members 0 1 2. '
+            'The ens#### part of --indir is swapped for each member (or appended if --indir has none); '
+            'each member is written to <outdir>/ens####/ and the ensemble mean and spread to <outdir>.'
+    )
+    parser.add_argument('--weights_file',type=str,
+        help='Optional .npz file to save/reuse regrid weights and ocean mask across jobs (.npz is added if missing). '
+            'With --band_size, one file per band is written next to it.'
+    )
+    parser.add_argument('--degout',nargs=2,type=float,
+        metavar=('Lat','Lon'),
+        help=f"Output grid spacing in degrees. Default: {DEGOUT['lat']} {DEGOUT['lon']}"
+    )
+    parser.add_argument('--band_size',type=float,
+        help='Regrid in latitude bands of this many degrees, writing each band straight to the '
+            'output file, so peak memory is set by the band rather than the whole grid. '
+            'Use for fine (sub-0.1 degree) grids. The ensemble (--members) and --aggregate '
+            'accumulators are still whole grids, so with those the peak is set by them, not the band.'
+    )
+    parser.add_argument('--no_band_cache',dest='band_cache',
+        action='store_false',
+        help='With --band_size and no --weights_file, rebuild every band\'s weights every month '
+            'instead of keeping them in <outdir>/regrid_cache/.'
+    )
+    parser.add_argument('--band_halo',type=float,default=1.0,
+        help='Degrees of latitude of model tiles to include either side of the --regrid_backend auto '
+            'calibration band. --band_size regrids triangulate all the tiles once, so their bands '
+            'need no halo. Default: %(default)s'
+    )
+    parser.add_argument('--regrid_backend',type=str,
+        default='weights',choices=['auto']+BACKENDS,
+        help='How to interpolate: griddata (scipy, per variable), weights (cached sparse weights, '
+            'identical to griddata), or auto: time both on the tiles and use the fastest within '
+            '--regrid_tolerance of griddata. As the two give the same numbers, auto comes out as '
+            'weights, after a calibration. '
+            'Default: %(default)s'
+    )
+    parser.add_argument('--regrid_tolerance',type=float,default=1e-3,
+        help='For --regrid_backend auto: largest error relative to griddata (as a fraction of the '
+            'largest value) and fraction of mismatched ocean-mask points allowed. Default: %(default)s'
+    )
+    parser.add_argument('--precision',type=str,
+        default='float64',choices=['float64','float32'],
+        help='Working precision for tile data, coordinates, regrid weights, derived variables '
+            'and output. float32 halves memory and I/O. Default: %(default)s'
+    )
+    parser.add_argument('--check_precision',
+        action='store_true',
+        help='Regrid the first month with both float32 and float64, report the differences, and exit.'
+    )
+    parser.add_argument('--plan',
+        action='store_true',
+        help='Dry run: find the input files, tile count and output grid, estimate the runtime, '
+            'peak memory and output size of each stage, suggest Slurm resources, and exit.'
+    )
+    parser.add_argument('--cost_model',nargs='+',
+        metavar='FILE',
+        help='For --plan: benchmark (benchmarks/run_benchmarks.py --out) or --metrics JSON lines/CSV '
+            'files to calibrate the stage cost models with. Built-in rough costs are used without them.'
+    )
+    parser.add_argument('--max_time',type=float,default=12.0,
+        help='For --plan: longest Slurm job (hours) to plan for; longer runs are split '
+            'into array tasks by year. Default: %(default)s'
+    )
+    parser.add_argument('--native',
+        action='store_true',
+        help='Skip regridding and write native tile-resolution output, with lat/lon as 1D '
+            'auxiliary coordinates on the tile dimension (CF timeSeries layout). Files are named '
+            '<input>-ILAMB.native.nc (with the default --suffix) so they never clash with regridded output.'
+    )
+    parser.add_argument('--sites',type=str,
+        help='CSV of sites (columns: site,lon,lat). Instead of regridding, extract a (site,time) '
+            'time series for the whole record directly from the native tiles, written to '
+            '<prefix>.sites.<site_method>.nc.'
+    )
+    parser.add_argument('--site_method',type=str,
+        default='nearest',choices=['nearest','idw'],
+        help='How sites pick up tile values: nearest tile, or inverse-distance weighting '
+            'of the 4 nearest tiles. Default: %(default)s'
+    )
+    parser.add_argument('--qa',
+        action='store_true',
+        help='Check every regridded month against its native tiles: area-weighted global and zonal '
+            'totals of each variable, land area, and tiles lost to the ocean mask. Deviations beyond '
+            '--qa_tolerance are printed and recorded in --metrics. Ignored with --native and --sites.'
+    )
+    parser.add_argument('--qa_tolerance',type=float,default=0.05,
+        help='For --qa: largest relative deviation of a total (or share of tiles lost) before it '
+            'is flagged. Default: %(default)s'
+    )
+    parser.add_argument('--qa_zone_size',type=float,default=10.0,
+        help='For --qa: height in degrees of the latitude zones for the zonal totals. Default: %(default)s'
+    )
+    parser.add_argument('--qa_tile_area',type=float,
+        help='For --qa: area of one tile in m2. Default: worked out from the longitude spacing of '
+            'the tiles, taking them to be global EASE-Grid 2.0 cells (about 8.1e7 for M09)'
+    )
+    parser.add_argument('--metrics',type=str,
+        help='Append per-stage metrics (wall and CPU time, bytes read/written, memory) for every '
+            'file to this file: CSV if it ends in .csv, JSON lines otherwise.'
+    )
+    parser.add_argument('--profile_stage',type=str,
+        choices=STAGES,
+        help='Run cProfile over every occurrence of this stage. The stats are written next to '
+            '--metrics as <name>.<stage>.prof, or the top entries printed without it.'
+    )
+    parser.add_argument('--trace_memory',
+        action='store_true',
+        help='With --metrics, also record the peak allocation of each stage with tracemalloc '
+            '(slightly slower).'
+    )
+    parser.add_argument('-v','--verbose',
+        action='store_true',
+        help='Verbose output'
+    )
+    parser.add_argument('-f','--force_overwrite',
+        action='store_true',
+        help='Force overwrite of any existing output files'
+    )
+
+    return parser.parse_args(argv)
+
+
+def task_command(argv):
+    """ 
+    `argv` without --years and the --plan options, for the Slurm array
+    tasks that --plan suggests.
+    """
+    drop = {'--plan':0,'--cost_model':None,'--max_time':1,'--years':2}
+    command,i = [],0
+    while i < len(argv):
+        arg = argv[i]
+        i += 1
+        name = arg.split('=',1)[0]
+        if name not in drop:
+            command.append(arg)
+        elif '=' not in arg:
+            if drop[name] is None:
+                # nargs='+': everything up to the next option
+                while i < len(argv) and not argv[i].startswith('-'):
+                    i += 1
+            else:
+                i += drop[name]
+    return command
+
+
+def config_from_args(args):
+    """ 
+    Builds a Config from parsed command-line arguments.
+    """
+    fields = {f.name for f in dataclasses.fields(Config)}
+    kwargs = {k:v for k,v in vars(args).items() if k in fields and v is not None}
+    if args.degout:
+        kwargs['degout'] = {'lat':args.degout[0],'lon':args.degout[1]}
+    return Config(**kwargs)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = config_from_args(args)
+
+    from .pipeline import Pipeline
+
+    pipeline = Pipeline(config)
+    try:
+        if args.plan:
+            # Dry run: estimate the run from the cost models and stop
+            from .plan import plan
+            command = ['python',sys.argv[0]]+task_command(sys.argv[1:] if argv is None else argv)
+            plan(pipeline,cost_files=args.cost_model,max_time=args.max_time,command=command)
+        elif args.check_precision:
+            # Diagnostic mode: compare float32 against float64 on the first month and stop
+            pipeline.check_precision()
+        else:
+            pipeline.run()
+    except (FileNotFoundError,ValueError) as e:
+        print(f'\n!!==> {e}')
+        sys.exit(1)
+    finally:
+        pipeline.metrics.close()
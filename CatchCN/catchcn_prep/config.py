@@ -0,0 +1,89 @@
+"""
+Configuration for the Catchment-CN -> ILAMB preprocessing pipeline.
+
+Nothing here imports numpy, xarray or scipy, so building a Config
+(or printing --help) doesn't pay for the heavy imports.
+"""
+import copy
+from dataclasses import dataclass, field
+
+# map native variable names to CF variable names
+VMAP = {
+    'CNNPP':'npp',
+    'CNGPP':'gpp',
+    'LAI':'lai',
+    'CNSR':'re',
+    'lon':'lon',
+    'lat':'lat'
+}
+
+# then we can use those new variables to define some derived variables
+DVMAP = {
+    'gpp-npp':{
+        'name':'rh',
+        'long_name':'heterotrophic_respiration',
+        'units':'kg m-2 s-1'
+    },
+    're-rh':{
+        'name':'ra',
+        'long_name':'autotrophic_respiration',
+        'units':'kg m-2 s-1'
+    }
+}
+
+DEGOUT = {'lat':0.1,'lon':0.1}
+
+# regrid backends that can be picked with --regrid_backend, see backends.py
+BACKENDS = ['griddata','weights']
+
+
+@dataclass
+class Config:
+    """ 
+    Everything a preprocessing run needs to know.
+    Field names match the command-line options of preprocess_catchCN_final.py.
+    """
+    indir: str = None               # input directory, e.g. .../cat/ens0000/
+    outdir: str = None              # output directory
+    filetype: str = '*'             # substring used in the glob search for input files
+    years: tuple = None             # (start,end), inclusive
+    months: tuple = (1,12)          # (start,end), inclusive
+    suffix: str = '-ILAMB'          # added to output filenames
+    force_overwrite: bool = False
+    verbose: bool = False
+
+    # regridding
+    degout: dict = field(default_factory=lambda: dict(DEGOUT))
+    precision: str = 'float64'      # 'float64' or 'float32'
+    weights_file: str = None        # optional .npz cache of regrid weights
+    band_size: float = None         # latitude band height (degrees) for streaming regrid
+    band_halo: float = 1.0
+    band_cache: bool = True         # keep band weights in <outdir>/regrid_cache/ without weights_file
+    max_distance: float = 0.1       # ocean mask cutoff (degrees)
+    regrid_backend: str = 'weights' # see backends.py, or 'auto'
+    regrid_tolerance: float = 1e-3  # accuracy 'auto' has to meet, relative to griddata
+
+    # output modes
+    native: bool = False            # write native tiles instead of regridding
+    sites: str = None               # CSV of sites for point extraction
+    site_method: str = 'nearest'    # 'nearest' or 'idw'
+    aggregate: list = None          # any of 'annual', 'climatology'
+    daily: bool = False             # reduce daily files to monthly means
+    daily_extremes: bool = False
+    allow_missing_days: bool = False    # average a month with missing daily files instead of failing
+    members: list = None            # ensemble member numbers
+
+    # QA of the regridded output, see qa.py
+    qa: bool = False                # compare native and regridded totals every month
+    qa_tolerance: float = 0.05      # largest relative deviation before a check is flagged
+    qa_zone_size: float = 10.0      # latitude zones (degrees) for the zonal totals
+    qa_tile_area: float = None      # m2 per tile; worked out from the tile spacing if not set
+
+    # performance metrics
+    metrics: str = None             # .jsonl or .csv file for per-stage metrics
+    profile_stage: str = None       # stage to run under cProfile
+    trace_memory: bool = False      # also record tracemalloc peak allocation per stage
+
+    # variables
+    vmap: dict = field(default_factory=lambda: dict(VMAP))
+    dvmap: dict = field(default_factory=lambda: copy.deepcopy(DVMAP))
@@ -0,0 +1,74 @@
+"""
+Ensemble members: locating each member's input and streaming ensemble statistics.
+"""
+import os
+import re
+
+import numpy as np
+import xarray as xr
+
+from .layout import spatial_coords, spatial_field
+from .times import time_encoding
+
+
+def member_indir(indir,member):
+    """ 
+    Points `indir` at ensemble member `member`,
+    e.g. .../cat/ens0000/ -> .../cat/ens0002/
+    """
+    if re.search(r'ens\d{4}',indir):
+        return re.sub(r'ens\d{4}',f'ens{member:0>4}',indir)
+    return os.path.join(indir,f'ens{member:0>4}','')
+
+
+def init_ensemble():
+    """ 
+    Sets up the (empty) running ensemble accumulators for one month.
+    """
+    return {'n':0,'coords':None,'dims':{},'attrs':{},'mean':{},'m2':{}}
+
+
+def update_ensemble(ens,df):
+    """ 
+    Folds one member's regridded month into the running ensemble mean
+    and sum of squared deviations (Welford), so only one member
+    has to be held in memory at a time.
+    """
+    ens['n'] += 1
+    n = ens['n']
+    if ens['coords'] is None:
+        ens['coords'] = spatial_coords(df)
+
+    for var in df.data_vars:
+        if var == 'time_bnds':
+            continue
+        field = spatial_field(df[var])
+        x = field.values
+        if var not in ens['mean']:
+            ens['dims'][var] = field.dims
+            ens['attrs'][var] = dict(df[var].attrs)
+            ens['mean'][var] = np.zeros(x.shape,dtype=x.dtype)
+            ens['m2'][var] = np.zeros(x.shape,dtype=x.dtype)
+        delta = x-ens['mean'][var]
+        ens['mean'][var] += delta/n
+        ens['m2'][var] += delta*(x-ens['mean'][var])
+
+
+def finalize_ensemble(ens,year,month):
+    """ 
+    Turns the ensemble accumulators into a dataset with `<var>` (ensemble mean)
+    and `<var>_spread` (ensemble standard deviation) for this month.
+    """
+    n = ens['n']
+    df = xr.Dataset(coords=ens['coords'])
+    for var,mean in ens['mean'].items():
+        df[var] = (ens['dims'][var],mean,ens['attrs'][var])
+        df[var].attrs['ensemble_members'] = n
+
+        spread = np.sqrt(ens['m2'][var]/(n-1)) if n > 1 else np.full(mean.shape,np.nan,dtype=mean.dtype)
+        df[var+'_spread'] = (ens['dims'][var],spread,dict(ens['attrs'][var]))
+        if 'long_name' in df[var+'_spread'].attrs:
+            df[var+'_spread'].attrs['long_name'] += '_ensemble_standard_deviation'
+        df[var+'_spread'].attrs['ensemble_members'] = n
+
+    return time_encoding(df,year,month)
@@ -0,0 +1,54 @@
+"""
+Helpers for the spatial layout of datasets: the compact native-tile layout,
+and pulling the spatial part out of a dataset that may be a lat/lon grid or tiles.
+"""
+import numpy as np
+
+from .regrid import geometry_key
+
+
+def native_tile_layout(df,cache=None):
+    """ 
+    Lays out native tile data for writing: lat/lon become plain 1D auxiliary
+    coordinates on the `tile` dimension and each tile is a CF timeSeries
+    feature. This replaces set_index(tile=['lat','lon']), which builds a pandas
+    MultiIndex over every tile and can't be written to netCDF as-is.
+    Pass the same `cache` dict on every call to build the tile coordinate
+    variables only once per tile geometry.
+    """
+    tdim = df['lat'].dims[0]
+    if tdim != 'tile':
+        df = df.rename_dims({tdim:'tile'})
+
+    cache = {} if cache is None else cache
+    key = geometry_key(df['lon'].values,df['lat'].values,[],[])
+    if key not in cache:
+        cache.clear()
+        cache[key] = {
+            'tile':(['tile'],np.arange(df.sizes['tile'],dtype=np.int32),
+                {'long_name':'tile index','cf_role':'timeseries_id'}),
+            'lat':(['tile'],df['lat'].values,
+                {**df['lat'].attrs,'standard_name':'latitude','units':'degrees_north'}),
+            'lon':(['tile'],df['lon'].values,
+                {**df['lon'].attrs,'standard_name':'longitude','units':'degrees_east'}),
+        }
+
+    df = df.drop_vars(['lat','lon']).assign_coords(cache[key])
+    df.attrs['featureType'] = 'timeSeries'
+
+    return df
+
+
+def spatial_field(da):
+    """ 
+    Drops a length-1 time dimension, leaving just the spatial field
+    (a lat/lon grid, or tiles for native output).
+    """
+    return da.isel(time=0,drop=True) if 'time' in da.dims else da
+
+
+def spatial_coords(df):
+    """ 
+    The coordinates of `df` that don't involve time, i.e. the output grid or tiles.
+    """
+    return {k:v.variable for k,v in df.coords.items() if 'time' not in v.dims}
@@ -0,0 +1,180 @@
+"""
+Per-stage performance metrics: wall and CPU time, bytes read/written and
+memory for every stage of every file, written as JSON lines or CSV, plus an
+optional cProfile of one chosen stage.
+
+    metrics = Metrics('run.jsonl',profile_stage='regrid')
+    metrics.set_context(file=infile,year=2006,month=1)
+    with metrics.stage('regrid',n=npoints,unit='points') as rec:
+        ...
+        rec['bytes_written'] = ...
+    metrics.close()
+
+A disabled Metrics (no path, no profile stage) records nothing and costs
+next to nothing, so it can be passed around unconditionally.
+"""
+import contextlib
+import csv
+import json
+import os
+import resource
+import time
+import tracemalloc
+
+# Stages recorded by the pipeline (regrid includes mask and weights when
+# those have to be built; run and the writers wrap everything else)
+STAGES = ['read','regrid','mask','weights','bands','native','qa','encode','write',
+    'ensemble','aggregate','sites','run']
+
+# Columns of the CSV output, in order; JSON lines records carry the same keys
+FIELDS = ['stage','file','member','year','month','wall_s','cpu_s','n','unit',
+    'bytes_read','bytes_written','rss_mb','max_rss_mb','peak_alloc_mb',
+    'qa_max_deviation','qa_flags']
+
+
+def io_counters():
+    """
+    (bytes read,bytes written) by this process so far, from /proc/self/io
+    (Linux only; includes reads served from the page cache). None elsewhere.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(':') for line in f)
+        return int(io['rchar']),int(io['wchar'])
+    except (OSError,KeyError,ValueError):
+        return None
+
+
+def rss_mb():
+    """
+    Current resident set size in MB (Linux only; None elsewhere).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/2**20
+    except (OSError,ValueError,IndexError):
+        return None
+
+
+class Metrics:
+    """
+    Records one metrics row per `stage()` block to `path` (.csv for CSV,
+    anything else for JSON lines), written as soon as the stage ends so the
+    rows survive a job that is killed part way.
+    `trace_memory` adds the stage's peak Python/numpy allocation from
+    tracemalloc, which slows allocation-heavy stages down a little.
+    `profile_stage` runs cProfile over every block of that stage and writes
+    the combined stats next to `path` (or prints the top entries without one).
+    """
+    def __init__(self,path=None,profile_stage=None,trace_memory=False):
+        self.path = path
+        self.profile_stage = profile_stage
+        self.trace_memory = trace_memory
+        self.enabled = bool(path or profile_stage)
+        self.context = {}
+        self.profiler = None
+        self._peaks = []    # running tracemalloc peak of each open stage
+        self._file = None
+        self._writer = None
+
+    @classmethod
+    def from_config(cls,config):
+        """
+        Builds Metrics from the metrics fields of a `Config`.
+        """
+        return cls(path=config.metrics,profile_stage=config.profile_stage,
+            trace_memory=config.trace_memory
+        )
+
+    def set_context(self,**context):
+        """
+        Sets the fields (file, member, year, month) stamped on the following rows.
+        """
+        self.context = context
+
+    @contextlib.contextmanager
+    def stage(self,name,n=None,unit=None):
+        """
+        Times the enclosed block as stage `name`. Yields the row, so the block
+        can fill in what only it knows (e.g. bytes_written for a netCDF file).
+        """
+        if not self.enabled:
+            yield {}
+            return
+
+        rec = {'stage':name,**self.context,'n':n,'unit':unit}
+        profile = name == self.profile_stage
+        if profile:
+            import cProfile
+            if self.profiler is None:
+                self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if self.trace_memory:
+            # Nested stages each get their own peak; the enclosing stage keeps the max
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1],tracemalloc.get_traced_memory()[1])
+            else:
+                tracemalloc.start()
+            self._peaks.append(0)
+            tracemalloc.reset_peak()
+        io = io_counters()
+        wall,cpu = time.perf_counter(),time.process_time()
+        try:
+            yield rec
+        finally:
+            rec['wall_s'] = time.perf_counter()-wall
+            rec['cpu_s'] = time.process_time()-cpu
+            if profile:
+                self.profiler.disable()
+            if self.trace_memory:
+                peak = max(self._peaks.pop(),tracemalloc.get_traced_memory()[1])
+                rec['peak_alloc_mb'] = peak/2**20
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1],peak)
+                    tracemalloc.reset_peak()
+                else:
+                    tracemalloc.stop()
+            io_end = io_counters()
+            if io and io_end:
+                rec.setdefault('bytes_read',io_end[0]-io[0])
+                rec.setdefault('bytes_written',io_end[1]-io[1])
+            rec['rss_mb'] = rss_mb()
+            rec['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10
+            self.write(rec)
+
+    def write(self,rec):
+        """
+        Appends one row to the metrics file.
+        """
+        if not self.path:
+            return
+        if self._file is None:
+            self._file = open(self.path,'a',newline='')
+            if self.path.endswith('.csv'):
+                self._writer = csv.DictWriter(self._file,fieldnames=FIELDS,extrasaction='ignore')
+                if self._file.tell() == 0:
+                    self._writer.writeheader()
+        if self._writer:
+            self._writer.writerow(rec)
+        else:
+            self._file.write(json.dumps(rec)+'\n')
+        self._file.flush()
+
+    def close(self):
+        """
+        Closes the metrics file and writes (or prints) the profile, if any.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file,self._writer = None,None
+        if self.profiler is not None:
+            import pstats
+            if self.path:
+                fout = f'{os.path.splitext(self.path)[0]}.{self.profile_stage}.prof'
+                self.profiler.dump_stats(fout)
+                print(f'Wrote cProfile stats for stage {self.profile_stage} to {fout} '
+                    f'(view with: python -m pstats {fout})')
+            else:
+                print(f'\n• cProfile of stage {self.profile_stage}')
+                pstats.Stats(self.profiler).sort_stats('cumulative').print_stats(25)
+            self.profiler = None
@@ -0,0 +1,474 @@
+"""
+The monthly preprocessing pipeline:
+locate -> read (or reduce daily files) -> variable preprocessing
+-> regrid (or native tile layout) -> time encoding -> write,
+with optional ensemble statistics, temporal aggregation and site extraction.
+"""
+import dataclasses
+import glob
+import os
+
+import numpy as np
+import xarray as xr
+
+from .aggregate import aggregate_prefix, finalize_aggregates, init_aggregates, update_aggregates
+from .ensemble import finalize_ensemble, init_ensemble, member_indir, update_ensemble
+from .layout import native_tile_layout
+from .metrics import Metrics
+from .qa import check_regrid, ease2_tile_area
+from .regrid import Regridder
+from .sites import read_sites, resolve_sites, sample_sites
+from .times import aggregate_time_encoding, next_month, time_encoding
+from .variables import add_daily_extremes, daily_to_monthly_name, noleap_days, reduce_daily, variable_preprocessing
+
+
+class Pipeline:
+    """ 
+    Runs the preprocessing described by a `Config`.
+    All state lives on the instance: the Regridder (and its weights), the site
+    lookups and the native tile coordinates are built once and reused by every
+    later month, member and `run()` call. Pass an existing `regridder` to share
+    its warm weights between pipelines.
+    Per-stage metrics go to `self.metrics` (shared with the Regridder); call
+    `self.metrics.close()` when done to write out a --profile_stage profile.
+    """
+    def __init__(self,config,regridder=None):
+        self.config = config
+        self.metrics = Metrics.from_config(config)
+        self.regridder = regridder if regridder is not None else Regridder.from_config(config)
+        self.regridder.metrics = self.metrics
+        self.site_cache = {}
+        self.tile_cache = {}
+        self.qa_flagged = []    # (file,flags) of months that failed --qa
+        self.tile_area = config.qa_tile_area    # m2; worked out from the first month if not set
+
+    def run(self):
+        """ 
+        Processes every month (and member) in the configured range.
+        """
+        c = self.config
+        if not c.years:
+            raise ValueError('Missing the required --years argument.')
+
+        # Ensemble members to process; None means just indir as given
+        members = c.members if c.members else [None]
+
+        self.qa_flagged = []
+        with self.metrics.stage('run'):
+            self.run_months(members)
+
+        if self.qa_flagged:
+            print(f'\n!!==> QA flagged {len(self.qa_flagged)} files:')
+            for fname,flags in self.qa_flagged:
+                print(f'├ {fname}: {len(flags)} checks, e.g. {"; ".join(flags[:3])}')
+
+    def run_months(self,members):
+        """ 
+        The body of `run()`: every month of every member, then the aggregates.
+        """
+        c = self.config
+        start_year,stop_year = c.years
+        start_month,stop_month = c.months
+
+        # Site mode: skip regridding and pull time series straight from the tiles
+        if c.sites:
+            for member in members:
+                indir,outdir = self.member_dirs(member)
+                self.metrics.set_context(member=member)
+                with self.metrics.stage('sites'):
+                    self.run_sites(indir,outdir)
+            return
+
+        # Running accumulators for annual means and monthly climatology
+        aggregates = None
+        if c.aggregate:
+            aggregates = init_aggregates(c.aggregate,c.outdir,self.suffix)
+
+        for year in range(start_year,stop_year+1,1):
+            for month in range(start_month,stop_month+1,1):
+                ensemble = init_ensemble() if c.members else None
+                df_ens = None
+                if ensemble:
+                    infile,_ = self.find_input(member_indir(c.indir,members[0]),year,month)
+                    ens_fout = c.outdir+os.path.basename(infile).replace('.nc4',f'.ensemble{self.suffix}.nc')
+                    if os.path.exists(ens_fout):
+                        if c.force_overwrite:
+                            print('Overwriting previous ensemble mean and spread')
+                        else:
+                            # Only write members that are missing; aggregate the ensemble mean already written
+                            print(f'Ensemble mean and spread already written to {ens_fout}')
+                            ensemble = None
+                            if aggregates:
+                                df_ens = self.read_existing(ens_fout)
+
+                for member in members:
+                    indir,outdir = self.member_dirs(member)
+                    self.metrics.set_context(member=member,year=year,month=month)
+
+                    infile,df_regrid = self.process_month(indir,outdir,year,month,
+                        keep=bool(ensemble) or bool(aggregates and not c.members)
+                    )
+                    if df_regrid is None:
+                        continue
+
+                    if ensemble:
+                        # Fold this member into the running ensemble mean/spread
+                        with self.metrics.stage('ensemble',n=data_size(df_regrid),unit='values'):
+                            update_ensemble(ensemble,df_regrid)
+                    elif aggregates:
+                        # Fold this month into the running annual/climatology accumulators
+                        if aggregates['prefix'] is None:
+                            aggregates['prefix'] = aggregate_prefix(infile)
+                        with self.metrics.stage('aggregate',n=data_size(df_regrid),unit='values'):
+                            update_aggregates(aggregates,df_regrid,year,month)
+                    df_regrid.close()
+                    del df_regrid
+
+                if ensemble:
+                    self.metrics.set_context(file=os.path.basename(infile),year=year,month=month)
+                    with self.metrics.stage('ensemble') as rec:
+                        df_ens = finalize_ensemble(ensemble,year,month)
+                        print(f'Writing ensemble mean and spread of {ensemble["n"]} members to {ens_fout}')
+                        df_ens.to_netcdf(ens_fout,format='NETCDF4')
+                        rec['bytes_written'] = os.path.getsize(ens_fout)
+
+                # Aggregate the ensemble mean
+                if aggregates and df_ens is not None:
+                    if aggregates['prefix'] is None:
+                        aggregates['prefix'] = aggregate_prefix(infile)+'.ensemble'
+                    df_mean = df_ens.drop_vars([v for v in df_ens.data_vars if v.endswith('_spread')])
+                    with self.metrics.stage('aggregate',n=data_size(df_mean),unit='values'):
+                        update_aggregates(aggregates,df_mean,year,month)
+                del df_ens
+
+        # Flush whatever is still accumulating
+        if aggregates:
+            self.metrics.set_context()
+            with self.metrics.stage('aggregate'):
+                finalize_aggregates(aggregates)
+
+    @property
+    def suffix(self):
+        """ 
+        Suffix for output filenames. Native tile output gets its own
+        (-ILAMB.native.nc), so it's never mistaken for regridded output.
+        """
+        c = self.config
+        return f'{c.suffix}.native' if c.native else c.suffix
+
+    def read_existing(self,fout):
+        """ 
+        Reads back an output file from an earlier run, after checking it has the
+        layout this run writes (native tiles, or the degout grid).
+        """
+        with xr.open_dataset(fout) as df:
+            if self.config.native:
+                layout,ok = 'native tiles','tile' in df.dims
+            else:
+                target_lats,target_lons = self.regridder.target_grid()
+                layout = f'{self.regridder.degout["lon"]}x{self.regridder.degout["lat"]} degree grid'
+                ok = 'tile' not in df.dims and (df.sizes.get('lat'),df.sizes.get('lon')) == (len(target_lats),len(target_lons))
+            if not ok:
+                raise ValueError(f'{fout} is not on the {layout} of this run; '
+                    'use -f to overwrite it, or another --outdir')
+            return df.load()
+
+    def member_dirs(self,member):
+        """ 
+        Input and output directories for ensemble member `member`
+        (just indir/outdir when not running members).
+        """
+        c = self.config
+        if member is None:
+            return c.indir,c.outdir
+        indir = member_indir(c.indir,member)
+        outdir = f'{c.outdir}ens{member:0>4}/'
+        os.makedirs(outdir,exist_ok=True)
+        print(f'\n• Ensemble member {member:0>4}: {indir}')
+        return indir,outdir
+
+    def process_month(self,indir,outdir,year,month,keep=False):
+        """ 
+        Locates, preprocesses, regrids and writes one month of one input directory.
+        Returns the input filename and the regridded dataset.
+        If the output already exists (and we're not overwriting) it is read back
+        when `keep` is set, because a later stage still needs it; otherwise None is returned.
+        """
+        c = self.config
+        infile,infiles = self.find_input(indir,year,month)
+        self.metrics.context['file'] = os.path.basename(infile)
+
+        # Construct output filename
+        if outdir is None:
+            raise ValueError('Missing the required --outdir argument.')
+        fout = outdir+os.path.basename(infile).replace('.nc4',f'{self.suffix}.nc')
+        if c.verbose:
+            print(f'• Outfile: {fout}')
+
+        # Check for existing output file and overwrite if specified
+        if os.path.exists(fout):
+            if c.force_overwrite:
+                print('Overwriting previous ILAMB-formatted file')
+            elif keep:
+                # Later stages still need this month
+                print('Reading previous ILAMB-formatted file')
+                return infile,self.read_existing(fout)
+            else:
+                return infile,None
+
+        with self.metrics.stage('read',unit='tiles') as rec:
+            df = self.read_month(infile,infiles,year,month)
+            df = df.load()
+            rec['n'] = df['lat'].size
+            rec['files'] = len(infiles) if infiles else 1
+
+        if c.band_size and not c.native:
+            # Regrid band by band, straight into the output file
+            with self.metrics.stage('bands',unit='points') as rec:
+                self.regridder.regrid_to_file(df,fout,year,month)
+                rec['bytes_written'] = os.path.getsize(fout)
+                target_lats,target_lons = self.regridder.target_grid()
+                rec['n'] = len(target_lats)*len(target_lons)*len([v for v in df.data_vars if v not in ('lat','lon')])
+            if c.qa:
+                # The bands are only on disk; read them back one variable at a time
+                with xr.open_dataset(fout) as df_out:
+                    self.check_month(df,df_out)
+            del df
+            if not keep:
+                return infile,None
+            # Opened lazily, so the ensemble/aggregate stages read one variable at a time;
+            # the caller closes it
+            return infile,xr.open_dataset(fout)
+
+        if c.native:
+            # Keep the native tiles, just laid out compactly
+            with self.metrics.stage('native',n=df['lat'].size,unit='tiles'):
+                df_regrid = native_tile_layout(df,cache=self.tile_cache)
+        else:
+            # Regrid onto a regular grid defined by degout
+            df_regrid = self.regridder.regrid(df)
+            if c.qa:
+                self.check_month(df,df_regrid)
+        del df
+
+        # Add the time variable and calendar encoding
+        with self.metrics.stage('encode',n=data_size(df_regrid),unit='values'):
+            df_regrid = time_encoding(df_regrid,year,month)
+
+        # Write to netCDF
+        print('Writing '+fout)
+        with self.metrics.stage('write',unit='bytes') as rec:
+            df_regrid.to_netcdf(fout,format='NETCDF4')
+            rec['n'] = rec['bytes_written'] = os.path.getsize(fout)
+
+        return infile,(df_regrid if keep else None)
+
+    def check_month(self,df,df_regrid):
+        """ 
+        --qa: compares one regridded month with its native tiles (see qa.py),
+        records the worst deviation and any flags in the metrics, and prints the flags.
+        """
+        c = self.config
+        with self.metrics.stage('qa',n=data_size(df_regrid),unit='values') as rec:
+            if self.tile_area is None:
+                self.tile_area = ease2_tile_area(df['lon'].values)
+                print(f'├ QA: counting each tile as {self.tile_area/1e6:.2f} km2')
+            qa = check_regrid(df,df_regrid,self.regridder.degout,
+                tolerance=c.qa_tolerance,zone_size=c.qa_zone_size,tile_area=self.tile_area)
+            rec['qa_max_deviation'] = qa['max_deviation']
+            rec['qa_flags'] = '; '.join(qa['flags'])
+            rec['qa_totals'] = qa['totals']
+
+        if qa['flags']:
+            fname = self.metrics.context.get('file')
+            self.qa_flagged.append((fname,qa['flags']))
+            print(f'!!==> QA: {len(qa["flags"])} checks off by more than {c.qa_tolerance:.0%}: '
+                + '; '.join(qa['flags'][:4])+(' ...' if len(qa['flags']) > 4 else ''))
+        elif c.verbose:
+            print(f'├ QA: all checks within {c.qa_tolerance:.0%} (worst {qa["max_deviation"]:.2%})')
+        return qa
+
+    def find_input(self,indir,year,month):
+        """ 
+        Locates the input for one month.
+        Returns the (monthly) input filename and, in daily mode,
+        the list of daily files for the month (otherwise None).
+        """
+        c = self.config
+        if indir is None:
+            raise ValueError('Missing the required --indir argument.')
+        ss = f'{indir}Y{year:0>4}/M{month:0>2}/*{c.filetype}*.nc4'
+
+        # Locate input file(s)
+        if c.daily:
+            # Every daily file in the month; the monthly means live in the same directory
+            infiles = sorted(f for f in glob.glob(ss) if '.monthly.' not in f)
+            if not infiles:
+                raise FileNotFoundError(f'No daily files found matching search string {ss}')
+            # The output is noleap, so 29 February isn't part of any month
+            infiles,leap = noleap_days(infiles)
+            if leap and c.verbose:
+                print(f'├ Leaving out {os.path.basename(leap[0])} (29 February; the output is in the noleap calendar)')
+            # Name the output after the monthly file this would have been
+            return daily_to_monthly_name(infiles[0],year,month),infiles
+
+        found = glob.glob(ss)
+        if not found:
+            raise FileNotFoundError(f'No file found matching search string {ss}')
+        return found[0],None
+
+    def read_month(self,infile,infiles,year,month):
+        """ 
+        Reads one month of native tile data (reducing daily files if needed)
+        and reformats the variables for ILAMB.
+        """
+        c = self.config
+        if c.daily:
+            # Reduce the daily files to a monthly mean in native tile space
+            print('=====\n=====')
+            print(f'\n Reducing {len(infiles)} daily files for {year}-{month:0>2}')
+            df,extremes = reduce_daily(infiles,year,month,c.vmap,
+                precision=c.precision,extremes=c.daily_extremes,verbose=c.verbose,
+                allow_missing_days=c.allow_missing_days
+            )
+
+            # Reformat variables for ILAMB
+            df = variable_preprocessing(df,c.vmap,c.dvmap,c.precision)
+            if extremes:
+                df = add_daily_extremes(df,extremes,c.vmap)
+        else:
+            # Open original Catchment-CN file            
+            df = xr.open_dataset(infile, decode_timedelta=True)
+            print('=====\n=====')
+            print(f'\n Reading {infile}')
+
+            # Reformat variables for ILAMB
+            df = variable_preprocessing(df,c.vmap,c.dvmap,c.precision)
+
+        return df
+
+    def run_sites(self,indir,outdir):
+        """ 
+        Builds a (site,time) netCDF for the whole record.
+        Sites are resolved to tiles once, and only those tiles are read from every
+        monthly file, so nothing is regridded and the full tile arrays are never loaded
+        (except in daily mode, where the daily reduction needs them).
+        """
+        import cftime as cf
+
+        c = self.config
+        start_year,stop_year = c.years
+        start_month,stop_month = c.months
+        sites = read_sites(c.sites)
+
+        # One file per site method, named after the first month's input
+        infile,_ = self.find_input(indir,start_year,start_month)
+        fout = f'{outdir}{aggregate_prefix(infile)}.sites.{c.site_method}{c.suffix}.nc'
+        if os.path.exists(fout):
+            if not c.force_overwrite:
+                print(f'Site time series already written to {fout}')
+                return
+            print('Overwriting previous site time series')
+        print(f'\n• Extracting {len(sites["site"])} sites from {indir}')
+
+        series,attrs,times,bounds = {},{},[],[]
+        res,ntile = None,None
+        for year in range(start_year,stop_year+1,1):
+            for month in range(start_month,stop_month+1,1):
+                infile,infiles = self.find_input(indir,year,month)
+                if c.daily:
+                    raw = self.read_month(infile,infiles,year,month)
+                else:
+                    raw = xr.open_dataset(infile,decode_timedelta=True)
+                    if c.verbose:
+                        print(f'├ Reading {infile}')
+                tdim = raw['lat'].dims[0]
+
+                # Resolve the sites the first time, then just check the geometry is unchanged
+                if res is None:
+                    res = resolve_sites(raw['lon'].values,raw['lat'].values,sites,
+                        method=c.site_method,max_distance=c.max_distance,cache=self.site_cache
+                    )
+                    ntile = raw.sizes[tdim]
+                elif raw.sizes[tdim] != ntile:
+                    raise ValueError(f'Tile count in {infile} does not match the first file')
+
+                # Only the tiles feeding a site are read from disk
+                df = raw.isel({tdim:res['tiles']})
+                if not c.daily:
+                    df = variable_preprocessing(df,c.vmap,c.dvmap,c.precision)
+                raw.close()
+
+                for var in df.data_vars:
+                    if var in ('lat','lon'):
+                        continue
+                    attrs.setdefault(var,dict(df[var].attrs))
+                    series.setdefault(var,[]).append(sample_sites(df[var].values.reshape(-1),res))
+
+                nyear,nmonth = next_month(year,month)
+                times.append(cf.DatetimeNoLeap(year,month,1,0,0,0))
+                bounds.append([cf.DatetimeNoLeap(year,month,1,0,0,0),cf.DatetimeNoLeap(nyear,nmonth,1,0,0,0)])
+
+        # CF discrete sampling geometry: one time series per site
+        df = xr.Dataset(coords={
+            'site_name':(['site'],sites['site'],{'cf_role':'timeseries_id','long_name':'site name'}),
+            'lat':(['site'],sites['lat'].astype(c.precision),{'standard_name':'latitude','units':'degrees_north'}),
+            'lon':(['site'],sites['lon'].astype(c.precision),{'standard_name':'longitude','units':'degrees_east'}),
+        })
+        df['tile_distance'] = (['site'],res['distance'].astype(c.precision),{
+            'long_name':'distance from site to nearest model tile','units':'degrees'
+        })
+        for var,cols in series.items():
+            df[var] = (['site','time'],np.stack(cols,axis=1),attrs[var])
+        df = aggregate_time_encoding(df,times,bounds)
+        df.attrs['featureType'] = 'timeSeries'
+        df.attrs['site_method'] = c.site_method
+
+        print(f'Writing {len(sites["site"])} site time series to {fout}')
+        df.to_netcdf(fout,format='NETCDF4')
+
+    def check_precision(self,infile=None):
+        """ 
+        Runs the preprocessing and regrid for one file (default: the first
+        configured month) in float64 and in float32 and reports, per variable,
+        the largest absolute difference, that difference relative to the
+        largest float64 value, and how many grid points differ in masking.
+        The grid geometry is float64 either way, so only the values are rounded:
+        expect ~1e-7 relative and no mask differences (up to ~1e-6 in daily mode,
+        where the days are averaged in float32). Much more points to an
+        upcast/downcast problem.
+        """
+        c = self.config
+        year,month = c.years[0],c.months[0]
+        infiles = None
+        if infile is None:
+            infile,infiles = self.find_input(c.indir,year,month)
+
+        out = {}
+        for p in ('float64','float32'):
+            # Read it the way a run would (daily files reduced in that precision), without metrics
+            cp = dataclasses.replace(c,precision=p,metrics=None,profile_stage=None,daily=c.daily and infiles is not None)
+            pipeline = Pipeline(cp)
+            df = pipeline.read_month(infile,infiles,year,month)
+            out[p] = pipeline.regridder.regrid(df)
+            df.close()
+
+        print(f'\n• float32 vs float64 for {os.path.basename(infile)}')
+        print(f'{"variable":<12}{"dtype":>9}{"max abs diff":>15}{"max rel diff":>15}{"mask diffs":>12}')
+        for var in out['float64'].data_vars:
+            x64 = out['float64'][var].values
+            x32 = out['float32'][var].values
+            diff = np.abs(x32.astype(np.float64)-x64)
+            scale = np.nanmax(np.abs(x64)) if np.isfinite(x64).any() else np.nan
+            maxdiff = np.nanmax(diff) if np.isfinite(diff).any() else 0.0
+            masked = int((np.isnan(x32) != np.isnan(x64)).sum())
+            print(f'{var:<12}{str(x32.dtype):>9}{maxdiff:>15.3e}{maxdiff/scale:>15.3e}{masked:>12}')
+
+        return out
+
+
+def data_size(df):
+    """ 
+    Number of values in the data variables of `df`, the size used in the metrics.
+    """
+    return int(sum(df[v].size for v in df.data_vars if v not in ('lat','lon','time_bnds')))
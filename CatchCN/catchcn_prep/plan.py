@@ -0,0 +1,377 @@
+"""
+Dry-run planner (--plan): works out what a run would do without doing it
+(which input files exist, how many tiles, how big the target grid is) and
+estimates the runtime, peak memory and output size of each stage, plus the
+Slurm resources to ask for.
+
+Runtimes come from per-stage cost models (seconds = a + b x size) fitted to
+JSON lines from benchmarks/run_benchmarks.py or --metrics of earlier runs;
+stages the calibration doesn't cover fall back to DEFAULT_COSTS. Peak memory
+is an array-size model of the largest stage, scaled to the peak RSS seen in
+benchmark runs when there are any.
+"""
+import csv
+import json
+import math
+import os
+import shlex
+
+import numpy as np
+import xarray as xr
+
+from .ensemble import member_indir
+from .sites import read_sites
+
+# (seconds,seconds per unit) by stage, from run_benchmarks.py on synthetic
+# tiles (200k tiles, 0.25 degrees, float64). Only a rough guide; calibrate
+# with your own benchmark or --metrics output.
+DEFAULT_COSTS = {
+    'read':(0.0,4e-7),          # per tile
+    'build':(0.0,5e-6),         # per target grid point (ocean mask + weights)
+    'regrid':(0.0,5e-9),        # per output value (grid points x variables)
+    'griddata':(0.0,3.5e-6),    # per output value
+    'bands':(0.0,7e-7),         # per output value, band weights built from one triangulation
+    'native':(0.0,1e-8),        # per tile
+    'encode':(0.0,2e-9),        # per output value
+    'write':(0.0,2e-9),         # per byte
+    'aggregate':(0.0,2e-8),     # per output value
+    'ensemble':(0.0,2e-8),      # per output value
+    'qa':(0.0,1e-8),            # per output value
+}
+
+BASE_RSS_MB = 250       # interpreter, numpy/xarray/scipy/netCDF4
+LAND_FRACTION = 0.3     # share of target grid points that get weights
+MARGIN = 1.5            # safety factor on the Slurm time request
+
+
+def load_records(paths):
+    """
+    Reads benchmark or metrics records from JSON lines (or metrics CSV) files.
+    """
+    records = []
+    for path in paths or []:
+        with open(path,newline='') as f:
+            if path.endswith('.csv'):
+                for row in csv.DictReader(f):
+                    records.append({k:_number(v) for k,v in row.items()})
+            else:
+                records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def _number(v):
+    if v in ('',None):
+        return None
+    try:
+        return float(v)
+    except ValueError:
+        return v
+
+
+def calibration_samples(records):
+    """
+    (size,seconds) samples per planner stage. Benchmark records (which carry the
+    commit and host) are mapped onto the planner stages directly; for --metrics
+    records the nested mask and weights rows of a file become its 'build' and
+    are taken back out of its 'regrid' row. Negative times are left out.
+    """
+    samples = {}
+    def add(stage,n,wall):
+        # A regrid row can come out negative once its builds are taken out
+        # (timer noise on a warm cache); it says nothing about the cost
+        if n and wall is not None and wall >= 0:
+            samples.setdefault(stage,[]).append((float(n),float(wall)))
+
+    builds = {}
+    for rec in records:
+        stage,n,wall = rec.get('stage'),rec.get('n'),rec.get('wall_s')
+        if 'commit' in rec:
+            if stage == 'open_select':
+                add('read',rec.get('tiles'),wall)
+            elif stage == 'weights':
+                add('build',n,wall)
+            elif stage == 'apply':
+                add('regrid',n,wall)
+            elif stage in ('bands','griddata','encode','write'):
+                add(stage,n,wall)
+            continue
+
+        key = (rec.get('file'),rec.get('member'),rec.get('year'),rec.get('month'))
+        if stage in ('mask','weights'):
+            b = builds.setdefault(key,[0.0,0.0])
+            b[0] += (n or 0) if stage == 'mask' else 0
+            b[1] += wall or 0
+        elif stage == 'regrid':
+            if key in builds:
+                add('build',*builds[key])
+                wall = wall-builds.pop(key)[1]
+            add('regrid',n,wall)
+        elif stage in ('read','bands','native','qa','encode','write','aggregate','ensemble'):
+            add(stage,n,wall)
+    return samples
+
+
+def fit_costs(records):
+    """
+    Per-stage cost models {stage:(a,b,source)}: a least-squares line through the
+    calibration samples when they cover more than one size, otherwise a plain
+    rate through the origin; DEFAULT_COSTS for anything not covered.
+    """
+    costs = {stage:(a,b,'default') for stage,(a,b) in DEFAULT_COSTS.items()}
+    for stage,pairs in calibration_samples(records).items():
+        n,t = np.array(pairs).T
+        if len(np.unique(n)) > 1:
+            b,a = np.polyfit(n,t,1)
+            if a < 0 or b <= 0:
+                a,b = 0.0,t.sum()/n.sum()
+        else:
+            a,b = 0.0,t.sum()/n.sum()
+        costs[stage] = (float(a),float(b),f'{len(pairs)} samples')
+    return costs
+
+
+def peak_memory(tiles,points,nvars,itemsize,native=False,band_points=None,accumulators=0):
+    """
+    Array-size model of peak memory in bytes: the tile data (and its
+    triangulation), the largest of the weights build and the regridded output,
+    and any running accumulators (`accumulators` grids' worth of values).
+    """
+    mem = 2*tiles*nvars*itemsize+150*tiles
+    weights_per_point = LAND_FRACTION*(28+3*itemsize)
+    if native:
+        mem += 2*tiles*nvars*itemsize
+    elif band_points:
+        mem += 33*band_points+weights_per_point*band_points+nvars*band_points*itemsize
+    else:
+        weights = weights_per_point*points
+        mem += weights+max(33*points,2*nvars*points*itemsize)
+    mem += accumulators*nvars*(tiles if native else points)*itemsize
+    return mem
+
+
+def memory_scale(records):
+    """
+    Median ratio of the peak RSS seen in benchmark runs to what `peak_memory()`
+    predicts for them, or 1 without benchmark records.
+    """
+    runs = {}
+    for rec in records:
+        rss = rec.get('process_peak_rss_mb') or rec.get('max_rss_mb')  # max_rss_mb in older files
+        if 'commit' in rec and rss and rec.get('degout'):
+            key = (rec.get('host'),rec.get('commit'),rec.get('tiles'),tuple(rec['degout']),rec.get('precision'))
+            runs[key] = max(runs.get(key,0),rss)
+    ratios = []
+    for (_,_,tiles,degout,precision),observed in runs.items():
+        points = math.ceil(180/degout[0])*math.ceil(360/degout[1])
+        predicted = BASE_RSS_MB+peak_memory(tiles,points,6,np.dtype(precision).itemsize)/2**20
+        ratios.append(observed/predicted)
+    return float(np.clip(np.median(ratios),0.5,4)) if ratios else 1.0
+
+
+def resolve_inputs(pipeline):
+    """
+    Input files of every month and member in the configured range, and the
+    months that have none.
+    """
+    c = pipeline.config
+    found,missing = [],[]
+    for member in (c.members or [None]):
+        indir = c.indir if member is None else member_indir(c.indir,member)
+        for year in range(c.years[0],c.years[1]+1):
+            for month in range(c.months[0],c.months[1]+1):
+                try:
+                    infile,infiles = pipeline.find_input(indir,year,month)
+                except FileNotFoundError:
+                    missing.append((member,year,month))
+                    continue
+                found.append({'member':member,'year':year,'month':month,'files':infiles or [infile]})
+    return found,missing
+
+
+def plan(pipeline,cost_files=None,max_time=12.0,command=None):
+    """
+    Estimates a run of `pipeline` without running it; see the module docstring.
+    `max_time` (hours) is the longest Slurm job to plan for, and `command` the
+    command line (without --years) that the suggested array tasks run.
+    Returns the estimates as a dict.
+    """
+    c = pipeline.config
+    if not c.years:
+        raise ValueError('Missing the required --years argument.')
+    if c.indir is None:
+        raise ValueError('Missing the required --indir argument.')
+    records = load_records(cost_files)
+    costs = fit_costs(records)
+    cost = lambda stage,n: costs[stage][0]+costs[stage][1]*n
+
+    found,missing = resolve_inputs(pipeline)
+    if not found:
+        raise FileNotFoundError(f'No input files found under {c.indir} for the configured years and months')
+    input_bytes = sum(os.path.getsize(f) for m in found for f in m['files'])
+
+    # Tile count and variables from the header of the first file
+    with xr.open_dataset(found[0]['files'][0],decode_timedelta=True) as raw:
+        tiles = raw['lat'].size
+        nvars = len([v for v in c.vmap if v in raw.variables and v not in ('lat','lon')])+len(c.dvmap)
+    itemsize = np.dtype(c.precision).itemsize
+
+    target_lats,target_lons = pipeline.regridder.target_grid()
+    points = len(target_lats)*len(target_lons)
+    band_points = None
+    if c.band_size and not c.native:
+        band_points = max(1,int(round(c.band_size/c.degout['lat'])))*len(target_lons)
+    values = (tiles if c.native else points)*nvars
+    out_bytes = values*itemsize
+
+    members = len(c.members) if c.members else 1
+    years = c.years[1]-c.years[0]+1
+    months_per_member = len(found)//members
+
+    # Seconds per stage over the whole run
+    totals = {}
+    def charge(stage,n,times=1):
+        totals[stage] = totals.get(stage,0.0)+times*cost(stage,n)
+
+    site_tiles = None
+    if c.sites and not c.daily:
+        # Only the tiles feeding a site are read (plus the coordinates once, to resolve them)
+        site_tiles = len(read_sites(c.sites)['site'])*(4 if c.site_method == 'idw' else 1)
+        charge('read',tiles*2/max(1,nvars))
+    for m in found:
+        charge('read',site_tiles or tiles,len(m['files']))
+        if c.sites:
+            continue
+        if c.native:
+            charge('native',tiles)
+        elif band_points:
+            charge('bands',values)
+        elif pipeline.regridder.backend == 'griddata':
+            charge('griddata',values)
+        else:
+            charge('regrid',values)
+        if c.qa and not c.native:
+            charge('qa',values)
+        if not band_points:
+            charge('encode',values)
+            charge('write',out_bytes)
+        if c.members:
+            charge('ensemble',values)
+        elif c.aggregate:
+            charge('aggregate',values)
+    if not (c.sites or c.native or band_points):
+        charge('build',points)      # once per job; the weights are then cached
+    if c.members and not c.sites:
+        ensemble_months = months_per_member
+        charge('write',2*out_bytes,ensemble_months)
+        if c.aggregate:
+            charge('aggregate',values,ensemble_months)
+
+    # Output size
+    output = {'monthly':0 if c.sites else len(found)*out_bytes}
+    if c.members and not c.sites:
+        output['ensemble'] = months_per_member*2*out_bytes
+    if c.aggregate and not c.sites:
+        if 'annual' in c.aggregate:
+            output['annual'] = years*out_bytes
+        if 'climatology' in c.aggregate:
+            output['climatology'] = 2*min(12,c.months[1]-c.months[0]+1)*out_bytes
+
+    # Peak memory
+    accumulators = 0
+    if c.members:
+        accumulators += 2
+    if c.aggregate and 'annual' in c.aggregate:
+        accumulators += 1+2/itemsize                                    # sum, uint16 days
+    if c.aggregate and 'climatology' in c.aggregate:
+        accumulators += (2+2/itemsize)*min(12,c.months[1]-c.months[0]+1)  # mean, m2, uint16 count
+    scale = memory_scale(records)
+    peak = BASE_RSS_MB*2**20+scale*peak_memory(tiles,points,nvars,itemsize,
+        native=c.native or bool(c.sites),band_points=band_points,accumulators=0 if c.sites else accumulators)
+
+    # Slurm: split by years into array tasks that each fit in max_time
+    # (the climatology needs every year in one job)
+    total = sum(totals.values())
+    once = totals.get('build',0.0)
+    per_year = (total-once)/years
+    if c.aggregate and 'climatology' in c.aggregate:
+        workers = 1
+    else:
+        workers = min(years,max(1,math.ceil(MARGIN*total/(3600*max_time))))
+        while workers < years and MARGIN*(once+per_year*math.ceil(years/workers)) > 3600*max_time:
+            workers += 1
+    years_per_task = math.ceil(years/workers)
+    workers = math.ceil(years/years_per_task)
+    task_time = max(600,MARGIN*(once+per_year*years_per_task))
+    task_time = 300*math.ceil(task_time/300)
+    mem_gb = math.ceil(1.2*peak/2**30)
+
+    result = {
+        'input_files':sum(len(m['files']) for m in found),
+        'input_bytes':input_bytes,
+        'months':len(found),
+        'missing':missing,
+        'tiles':tiles,
+        'variables':nvars,
+        'grid_points':points,
+        'stage_seconds':totals,
+        'total_seconds':total,
+        'output_bytes':output,
+        'peak_memory_bytes':peak,
+        'memory_scale':scale,
+        'costs':costs,
+        'workers':workers,
+        'years_per_task':years_per_task,
+        'task_seconds':task_time,
+        'task_memory_gb':mem_gb,
+    }
+    print_plan(c,result,max_time,command)
+    return result
+
+
+def print_plan(c,p,max_time,command=None):
+    """
+    Prints the plan returned by `plan()`.
+    """
+    print(f'\n• Plan for {c.indir}, {c.years[0]}-{c.years[1]} months {c.months[0]}-{c.months[1]}')
+    print(f'├ Input: {p["input_files"]} files ({p["input_bytes"]/2**30:.2f} GB) for {p["months"]} months')
+    if p['missing']:
+        shown = ', '.join(f'{y}-{m:0>2}'+(f' (ens{e:0>4})' if e is not None else '') for e,y,m in p['missing'][:6])
+        print(f'├ !!==> No input for {len(p["missing"])} months: {shown}{" ..." if len(p["missing"]) > 6 else ""}')
+    print(f'├ {p["tiles"]:,} tiles, {p["variables"]} output variables, '
+        + ('native tile output' if c.native else f'{p["grid_points"]:,} grid points ({c.degout["lon"]}x{c.degout["lat"]} degrees)'))
+
+    print(f'\n{"stage":<12}{"seconds":>12}{"share":>8}   cost model')
+    for stage,secs in sorted(p['stage_seconds'].items(),key=lambda kv: -kv[1]):
+        a,b,source = p['costs'][stage]
+        print(f'{stage:<12}{secs:>12.1f}{secs/max(p["total_seconds"],1e-9):>8.0%}   {a:.2g} + {b:.2g}/unit ({source})')
+    print(f'{"total":<12}{p["total_seconds"]:>12.1f}   ({p["total_seconds"]/3600:.2f} hours in one job)')
+    defaults = [s for s in p['stage_seconds'] if p['costs'][s][2] == 'default']
+    if defaults:
+        print(f'!!==> No calibration for {", ".join(defaults)}: using rough built-in costs '
+            '(pass --cost_model with benchmark or --metrics output)')
+
+    print(f'\n• Output: {sum(p["output_bytes"].values())/2**30:.2f} GB ('
+        + ', '.join(f'{k} {v/2**30:.2f} GB' for k,v in p['output_bytes'].items())+')')
+    print(f'• Peak memory: {p["peak_memory_bytes"]/2**30:.2f} GB'
+        + (f' (scaled x{p["memory_scale"]:.2f} to benchmark RSS)' if p['memory_scale'] != 1 else ''))
+    if c.aggregate and 'climatology' in c.aggregate and not c.sites:
+        print('├ Includes the climatology accumulators: mean, M2 and count for every calendar month')
+
+    hours,rest = divmod(int(p['task_seconds']),3600)
+    print(f'\n• Suggested Slurm request (limit {max_time:g} hours per job, x{MARGIN} margin):')
+    if p['workers'] > 1:
+        print(f'#SBATCH --array=0-{p["workers"]-1}')
+    print(f'#SBATCH --time={hours:0>2}:{rest//60:0>2}:00')
+    print(f'#SBATCH --mem={p["task_memory_gb"]}G')
+    print('#SBATCH --ntasks=1')
+    print('#SBATCH --cpus-per-task=1')
+    if p['workers'] > 1:
+        n = p['years_per_task']
+        print(f'• {p["workers"]} array tasks of {n} years each (the last one capped at {c.years[1]}):')
+        print(f'START=$(({c.years[0]}+SLURM_ARRAY_TASK_ID*{n}))')
+        print(f'END=$((START+{n-1} < {c.years[1]} ? START+{n-1} : {c.years[1]}))')
+        print((shlex.join(command) if command else 'python preprocess_catchCN_final.py <options>')+' --years $START $END')
+        if not c.weights_file:
+            print('• Each task rebuilds the regrid weights; add --weights_file to build them once and share them')
+    elif c.aggregate and 'climatology' in c.aggregate and p['task_seconds'] > 3600*max_time:
+        print('!!==> The climatology needs every year in one job, and this one would run past the limit')
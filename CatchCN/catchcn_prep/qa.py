@@ -0,0 +1,170 @@
+"""
+Conservation and sanity checks of the regridded output (--qa), cheap enough to
+run on every month of a production job.
+
+For each variable, the area-weighted global and zonal totals of the native tiles
+(EASE-Grid 2.0 tiles all have the same area, see `ease2_tile_area()`) are compared
+with those of the output grid (cell area R^2 dlon (sin lat2 - sin lat1)). The land area covered
+by each is compared too, and so is the share of tiles whose nearest grid point
+was masked as ocean, which would mean the ocean mask erased real land.
+Everything is a bincount or a row sum over arrays that are already in memory.
+"""
+import numpy as np
+
+EARTH_RADIUS = 6371007.181              # m, authalic radius of WGS84 (EASE-Grid 2.0 is equal-area on it)
+WGS84_A = 6378137.0                     # m, semi-major axis
+WGS84_E2 = 0.0066943799901              # first eccentricity squared
+EASE2_LAT_TS = 30.0                     # latitude of true scale of the global EASE-Grid 2.0
+MIN_ZONE_SHARE = 0.01                   # zones with less of the land area than this aren't checked
+
+
+def ease2_tile_area(lon,decimals=5):
+    """
+    Area (m2) of one tile, taking the tiles to be global EASE-Grid 2.0 cells:
+    square, and as wide as their column spacing at the latitude of true scale.
+    The spacing is the longitude span of the tiles over the number of columns
+    it covers, e.g. 360/3856 degrees and (9008 m)^2 for M09.
+    """
+    lons = np.unique(np.round(np.asarray(lon,dtype=np.float64).ravel(),decimals))
+    if len(lons) < 2:
+        raise ValueError('Cannot work out the tile area from a single column of tiles; pass --qa_tile_area')
+    # Neighbouring columns only: columns without land leave wider gaps
+    steps = np.diff(lons)
+    step = float(np.median(steps[steps < 1.5*steps.min()]))
+    span = lons[-1]-lons[0]
+    columns = max(1,round(span/step))
+    if columns > 2*len(lons):
+        raise ValueError(f'The tile longitudes are not on EASE-Grid columns ({len(lons):,} distinct values '
+            f'{step:.2g} degrees or more apart), so the tile area is unknown; pass --qa_tile_area')
+    dlon = span/columns
+    sin_ts = np.sin(np.radians(EASE2_LAT_TS))
+    k0 = np.cos(np.radians(EASE2_LAT_TS))/np.sqrt(1-WGS84_E2*sin_ts**2)
+    return float((WGS84_A*k0*np.radians(dlon))**2)
+
+
+def cell_areas(target_lats,degout):
+    """
+    Area (m2) of one grid cell in each row of the target grid, whose
+    latitudes label the southern edge of the cells.
+    """
+    south = np.radians(np.clip(target_lats.astype(np.float64),-90,90))
+    north = np.radians(np.clip(target_lats.astype(np.float64)+degout['lat'],-90,90))
+    return EARTH_RADIUS**2*np.radians(degout['lon'])*(np.sin(north)-np.sin(south))
+
+
+def zone_edges(zone_size):
+    """
+    Latitude edges of the `zone_size`-degree zones.
+    """
+    return np.append(np.arange(-90,90,zone_size),90.0)
+
+
+def zone_index(lat,edges):
+    """
+    The zone each latitude falls in.
+    """
+    return np.clip(np.searchsorted(edges,lat,side='right')-1,0,len(edges)-2)
+
+
+def native_totals(df,variables,zone_size=10.0,tile_area=None):
+    """
+    Zonal totals (value x tile area) of each variable on the native tiles,
+    and the zonal land area, as float64 arrays over the zones.
+    `tile_area` (m2) defaults to `ease2_tile_area()`.
+    """
+    if tile_area is None:
+        tile_area = ease2_tile_area(df['lon'].values)
+    edges = zone_edges(zone_size)
+    zones = zone_index(df['lat'].values.ravel(),edges)
+    nzones = len(edges)-1
+    totals = {}
+    for var in variables:
+        values = df[var].values.ravel()
+        ok = np.isfinite(values)
+        totals[var] = np.bincount(zones[ok],weights=values[ok]*tile_area,minlength=nzones)
+    land = np.bincount(zones,minlength=nzones)*tile_area
+    return totals,land
+
+
+def grid_totals(df_regrid,variables,degout,zone_size=10.0):
+    """
+    Zonal totals (value x cell area) of each variable on the output grid, and
+    the zonal area of the cells that have values, as float64 arrays over the zones.
+    """
+    lats = df_regrid['lat'].values
+    area = cell_areas(lats,degout)
+    edges = zone_edges(zone_size)
+    zones = zone_index(lats.astype(np.float64),edges)
+    nzones = len(edges)-1
+    totals,land = {},None
+    for var in variables:
+        values = df_regrid[var].values.reshape(len(lats),-1)
+        finite = np.isfinite(values)
+        rows = np.sum(values,axis=-1,dtype=np.float64,where=finite)*area
+        totals[var] = np.bincount(zones,weights=rows,minlength=nzones)
+        if land is None:
+            cells = np.count_nonzero(finite,axis=-1)*area
+            land = np.bincount(zones,weights=cells,minlength=nzones)
+    return totals,land
+
+
+def masked_land(df,df_regrid,var,degout):
+    """
+    Fraction of tiles with a value in `var` whose nearest grid point has none,
+    i.e. land the ocean mask removed.
+    """
+    lon = df['lon'].values.ravel().astype(np.float64)
+    lat = df['lat'].values.ravel().astype(np.float64)
+    lats,lons = df_regrid['lat'].values,df_regrid['lon'].values
+    row = np.clip(np.rint((lat-lats[0])/degout['lat']).astype(np.int64),0,len(lats)-1)
+    col = np.rint((lon-lons[0])/degout['lon']).astype(np.int64)%len(lons)
+    tiles = np.isfinite(df[var].values.ravel())
+    grid = df_regrid[var].values.reshape(len(lats),len(lons))[row[tiles],col[tiles]]
+    return np.count_nonzero(np.isnan(grid))/max(1,np.count_nonzero(tiles))
+
+
+def relative(x,ref):
+    """
+    |x-ref|/|ref|, 0 where both are 0 and NaN where only ref is (there's no
+    relative deviation from nothing).
+    """
+    diff = np.abs(np.asarray(x)-ref)
+    return np.divide(diff,np.abs(ref),out=np.where(diff > 0,np.nan,0.0),where=ref != 0)
+
+
+def check_regrid(df,df_regrid,degout,tolerance=0.05,zone_size=10.0,tile_area=None):
+    """
+    Compares the native tiles in `df` with the regridded `df_regrid` (see the
+    module docstring). Zones with under MIN_ZONE_SHARE of the land area are
+    left out of the zonal check. `tile_area` (m2) defaults to `ease2_tile_area()`.
+    Returns a dict with the global totals of each variable, the deviation of each
+    global check, the worst relative deviation of any check, and the checks that
+    deviate by more than `tolerance`. A total that's 0 on the tiles but not on
+    the grid has no relative deviation: it's None (null in --metrics) and flagged.
+    """
+    variables = [v for v in df_regrid.data_vars if v in df and 'lat' not in v and 'lon' not in v]
+    native,native_land = native_totals(df,variables,zone_size,tile_area)
+    grid,grid_land = grid_totals(df_regrid,variables,degout,zone_size)
+    edges = zone_edges(zone_size)
+    checked = native_land >= MIN_ZONE_SHARE*native_land.sum()
+
+    deviations = {'land area':float(relative(grid_land.sum(),native_land.sum()))}
+    if variables:
+        deviations['masked land'] = float(masked_land(df,df_regrid,variables[0],degout))
+    zonal = {'land area':relative(grid_land,native_land)}
+    totals = {}
+    for var in variables:
+        totals[var] = (float(native[var].sum()),float(grid[var].sum()))
+        deviations[var] = float(relative(totals[var][1],totals[var][0]))
+        zonal[var] = relative(grid[var],native[var])
+
+    describe = lambda dev: 'where the native total is 0' if np.isnan(dev) else f'{dev:.1%}'
+    flags = [f'{name} {describe(dev)}' for name,dev in deviations.items() if not dev <= tolerance]
+    worst = max([dev for dev in deviations.values() if not np.isnan(dev)],default=0.0)
+    for name,dev in zonal.items():
+        bad = np.flatnonzero(checked & ~(dev <= tolerance))
+        flags += [f'{name} {edges[z]:g} to {edges[z+1]:g} degrees {describe(dev[z])}' for z in bad]
+        if checked.any():
+            worst = max(worst,float(np.nanmax(dev[checked],initial=0.0)))
+    deviations = {name:(None if np.isnan(dev) else dev) for name,dev in deviations.items()}
+    return {'totals':totals,'deviations':deviations,'max_deviation':worst,'flags':flags}
@@ -0,0 +1,475 @@
+"""
+Regridding of native Catchment-CN tiles onto a regular lat/lon grid.
+
+`Regridder` holds the configuration and the cache of interpolation weights,
+so one instance can be reused across files, ensemble members and calls
+without rebuilding the triangulation or ocean mask. The interpolation itself
+is done by one of the backends in backends.py.
+"""
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import xarray as xr
+
+from .backends import BACKEND_CLASSES, choose_backend
+from .config import DEGOUT
+from .metrics import Metrics
+from .times import time_encoding
+
+
+class Regridder:
+    """ 
+    Regrids native data onto a regular grid with spacing `degout`
+    ({'lat':..,'lon':..} in degrees).
+    Also applies NaN values to any points on the
+    new lat/lon grid which are too far (`max_distance`) from the original data points 
+    (avoids interpolating into areas with no data).
+    The interpolation weights and ocean mask only depend on the tile geometry,
+    so they're built once per geometry (see `weights()`) and kept on the instance.
+    `backend` picks the interpolation (see backends.py); 'auto' calibrates the
+    backends on the tiles and takes the fastest within `tolerance` of griddata.
+    Stage timings go to `metrics` (see metrics.Metrics), if given.
+    """
+    def __init__(self,degout=None,precision='float64',weights_file=None,
+            band_size=None,band_halo=1.0,max_distance=0.1,verbose=False,metrics=None,
+            backend='weights',tolerance=1e-3,cache_dir=None,nfiles=1):
+        self.degout = dict(degout) if degout else dict(DEGOUT)
+        self.precision = precision
+        # np.savez adds .npz to any other name, so use that name for loading too
+        if weights_file and os.path.splitext(weights_file)[1] != '.npz':
+            weights_file += '.npz'
+        self.weights_file = weights_file
+        self.band_size = band_size
+        self.band_halo = band_halo
+        self.max_distance = max_distance
+        self.verbose = verbose
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.backend = backend
+        self.tolerance = tolerance
+        self.cache_dir = cache_dir
+        self.nfiles = nfiles    # files per run, over which 'auto' spreads the weights build
+        self.cache = {}     # weights built so far, keyed by geometry_key()
+        self.backends = {}  # backends built so far, keyed by (name,geometry_key())
+        self.decisions = {} # backend chosen by 'auto', keyed by geometry_key()
+
+    @classmethod
+    def from_config(cls,config):
+        """ 
+        Builds a Regridder from the regridding fields of a `Config`.
+        """
+        return cls(degout=config.degout,precision=config.precision,
+            weights_file=config.weights_file,band_size=config.band_size,
+            band_halo=config.band_halo,max_distance=config.max_distance,
+            verbose=config.verbose,backend=config.regrid_backend,
+            tolerance=config.regrid_tolerance,
+            cache_dir=os.path.join(config.outdir,'regrid_cache') if config.outdir and config.band_cache else None,
+            nfiles=run_files(config)
+        )
+
+    def target_grid(self,dtype=None):
+        """ 
+        Latitudes and longitudes of the target grid (cell lower-left corners),
+        in `dtype` (default: the working precision, as written to the output).
+        The ocean mask and weights are worked out on the float64 grid: most
+        coordinates of e.g. a 0.1 degree grid aren't exact in float32, and the
+        rounding would move the target points.
+        """
+        dtype = dtype or self.precision
+        target_lats = np.arange(-90,90,self.degout['lat']).astype(dtype)
+        target_lons = np.arange(-180,180,self.degout['lon']).astype(dtype)
+        return target_lats,target_lons
+
+    def regrid(self,df):
+        """ 
+        Regrids every variable in `df` (other than lat/lon) and returns
+        a new lat/lon dataset.
+        """
+        target_lats,target_lons = self.target_grid(np.float64)
+
+        # Create your output DataFrame
+        df_regridded = xr.Dataset(
+            coords={
+                'lon':(['lon'],target_lons.astype(self.precision)),
+                'lat':(['lat'],target_lats.astype(self.precision))
+            }
+        )
+
+        variables = [v for v in df.variables if not (('lat' in v) or ('lon' in v))]
+        model_lon,model_lat = df['lon'].values,df['lat'].values
+        name = self.resolve_backend(model_lon,model_lat,target_lons,target_lats,
+            df[variables[0]].values.flatten(),len(variables))
+        with self.metrics.stage('regrid',n=len(target_lats)*len(target_lons)*len(variables),unit='points'):
+            backend = self.get_backend(name,model_lon,model_lat,target_lons,target_lats,wfile=self.weights_file)
+
+            print(f'\n• Regridding data onto {self.degout['lon']}x{self.degout['lat']} degrees ({name})...')
+            grid_start = time.time()
+            for i, var in enumerate(df.variables):
+                if ('lat' in var) or ('lon' in var): 
+                    continue
+                print(f'├ Variable: {var} ({i}/{len(df.variables)})')
+                var_start = time.time()
+
+                # Interpolate, with the ocean mask applied
+                grid_values = backend.interpolate(df[var].values.flatten())
+
+                # Put it back into 2D
+                final_values = grid_values.reshape(len(target_lats),len(target_lons))
+            
+                # Add it to the new xarray dataset
+                df_regridded[var] = (['lat','lon'],final_values,df[var].attrs)
+            
+                var_time = time.time() - var_start
+                print(f'│ ⧖ {var} regrid time: {var_time:.2f}s')
+
+        grid_time = time.time() - grid_start
+        print(f'⧖ Regridding all variables in file took {grid_time:.2f} seconds')
+
+        return df_regridded
+
+    def regrid_to_file(self,df,fout,year,month):
+        """ 
+        Regrids one latitude band (`band_size` degrees) at a time and writes each
+        finished band straight into `fout`, so no full-grid array is ever
+        held in memory. All the tiles are triangulated once (its size is set by
+        the tiles, not the grid) and only the band's target points are located
+        in it, so the output matches the full-grid regrid: a triangulation of
+        part of the lattice could split the tile cells along other diagonals.
+        The griddata and weights backends both go through this triangulation;
+        the xESMF backends regrid the tiles within `band_halo` degrees of each band.
+        Weights aren't kept in memory between bands (that would grow with the grid
+        again), but they are saved per band alongside `weights_file` if that's set,
+        or else in `cache_dir` under the band's geometry key, so later months load
+        them and don't triangulate at all.
+        With backend 'auto' the choice is made once, on the whole tile set.
+        """
+        import netCDF4
+        from scipy.spatial import Delaunay, QhullError
+
+        target_lats,target_lons = self.target_grid(np.float64)
+        rows = max(1,int(round(self.band_size/self.degout['lat'])))
+
+        model_lon = df['lon'].values
+        model_lat = df['lat'].values
+        tile_values = {var:df[var].values.flatten() for var in df.variables
+            if not (('lat' in var) or ('lon' in var))}
+        name = self.resolve_backend(model_lon,model_lat,target_lons,target_lats,
+            next(iter(tile_values.values())),len(tile_values))
+
+        # Write the coordinates and time first, then fill the variables in band by band
+        skeleton = xr.Dataset(
+            coords={
+                'lon':(['lon'],target_lons.astype(self.precision)),
+                'lat':(['lat'],target_lats.astype(self.precision))
+            }
+        )
+        skeleton = time_encoding(skeleton,year,month)
+        skeleton.to_netcdf(fout,format='NETCDF4')
+        del skeleton
+
+        print(f'\n• Regridding data onto {self.degout['lon']}x{self.degout['lat']} degrees in {self.band_size} degree bands...')
+        grid_start = time.time()
+        with netCDF4.Dataset(fout,'a') as nc:
+            ncvars = {}
+            for var in tile_values:
+                ncvars[var] = nc.createVariable(var,np.dtype(self.precision),('lat','lon'),
+                    fill_value=np.nan,chunksizes=(min(rows,len(target_lats)),len(target_lons))
+                )
+                ncvars[var].setncatts(df[var].attrs)
+
+            tri = None  # triangulation of all the tiles, built the first time a band needs it
+            delaunay = name in ('griddata','weights')
+            halo = self.max_distance if delaunay else max(self.band_halo,self.max_distance)
+            nbands = int(np.ceil(len(target_lats)/rows))
+            for b,i in enumerate(range(0,len(target_lats),rows)):
+                band_lats = target_lats[i:i+rows]
+                # Tiles close enough to the band to be in its ocean mask (or its xESMF lattice)
+                sub = np.flatnonzero((model_lat >= band_lats[0]-halo) & (model_lat <= band_lats[-1]+halo))
+                if len(sub) < 3:
+                    # No land near the band; leave it as fill values
+                    continue
+                if self.verbose:
+                    print(f'├ Band {b+1}/{nbands}: {band_lats[0]:.2f} to {band_lats[-1]:.2f} ({len(sub):,} tiles)')
+
+                key = geometry_key(model_lon,model_lat,target_lons,band_lats)+self.precision
+                if self.weights_file:
+                    wfile = os.path.splitext(self.weights_file)[0]+f'.band{b:04}.npz'
+                elif self.cache_dir:
+                    os.makedirs(self.cache_dir,exist_ok=True)
+                    wfile = os.path.join(self.cache_dir,f'band.{key[:16]}.{self.precision}.{self.max_distance:g}.npz')
+                else:
+                    wfile = None
+
+                if delaunay:
+                    weights = self.load_weights(wfile,key) if wfile else None
+                    if weights is None:
+                        if tri is None:
+                            with self.metrics.stage('weights',n=len(model_lon),unit='tiles'):
+                                print(f'\n• Triangulating {len(model_lon):,} model points')
+                                tri = Delaunay(np.column_stack((model_lon,model_lat)))
+                        weights = self.weights(model_lon,model_lat,target_lons,band_lats,cache=False,tri=tri,near=sub)
+                        if wfile:
+                            self.save_weights(wfile,key,weights)
+                    for var,values in tile_values.items():
+                        band = apply_weights(weights,values)
+                        ncvars[var][i:i+len(band_lats),:] = band.reshape(len(band_lats),len(target_lons))
+                    del weights
+                    continue
+
+                try:
+                    backend = self.get_backend(name,model_lon[sub],model_lat[sub],target_lons,band_lats,wfile=wfile,cache=False)
+                except ValueError as e:
+                    # e.g. a single row of tiles at the edge of the data
+                    if self.verbose:
+                        print(f'│ Band {b+1} left empty: {e}')
+                    continue
+                for var,values in tile_values.items():
+                    band = backend.interpolate(values[sub])
+                    ncvars[var][i:i+len(band_lats),:] = band.reshape(len(band_lats),len(target_lons))
+                del backend
+            del tri
+
+        grid_time = time.time() - grid_start
+        print(f'⧖ Regridding all variables in file took {grid_time:.2f} seconds')
+
+    def resolve_backend(self,model_lon,model_lat,target_lons,target_lats,values,nvars=1):
+        """ 
+        Name of the backend to use for this tile geometry and grid. For 'auto'
+        that means calibrating the backends with `values` (one variable) the first
+        time; the choice is kept on the instance and, with `weights_file`, saved
+        next to it (<weights_file>.auto.json) for later jobs.
+        """
+        if self.backend != 'auto':
+            return self.backend
+
+        key = geometry_key(model_lon,model_lat,target_lons,target_lats)+self.precision
+        if key in self.decisions:
+            return self.decisions[key]
+
+        dfile = os.path.splitext(self.weights_file)[0]+'.auto.json' if self.weights_file else None
+        if dfile and os.path.exists(dfile):
+            with open(dfile) as f:
+                decision = json.load(f)
+            if decision['key'] == key and decision['tolerance'] == self.tolerance:
+                print(f'\n• Using the {decision["backend"]} regrid backend chosen earlier ({dfile})')
+                self.decisions[key] = decision['backend']
+                return decision['backend']
+            print(f'!!==> {dfile} was calibrated for a different tile geometry, grid or tolerance; recalibrating')
+
+        name,results = choose_backend(self,model_lon,model_lat,target_lons,target_lats,values,
+            nvars=nvars,tolerance=self.tolerance,band=self.band_size or 10.0,nfiles=self.nfiles
+        )
+        self.decisions[key] = name
+        if dfile:
+            with open(dfile,'w') as f:
+                json.dump({'key':key,'backend':name,'tolerance':self.tolerance,'calibration':results},f,indent=1)
+        return name
+
+    def get_backend(self,name,model_lon,model_lat,target_lons,target_lats,wfile=None,cache=True):
+        """ 
+        Builds (or fetches from cache) backend `name` for this tile geometry and grid.
+        `wfile` is the .npz weights file; the xESMF backends keep theirs next to it.
+        """
+        if name not in BACKEND_CLASSES:
+            raise ValueError(f'Unknown regrid backend {name}; choose from auto, {", ".join(BACKEND_CLASSES)}')
+        key = geometry_key(model_lon,model_lat,target_lons,target_lats)+self.precision
+        if (name,key) in self.backends:
+            return self.backends[(name,key)]
+
+        if wfile and name.startswith('xesmf'):
+            wfile = os.path.splitext(wfile)[0]+f'.{name}.{key[:12]}.nc'
+        elif name == 'griddata':
+            wfile = None
+        backend = BACKEND_CLASSES[name](self,model_lon,model_lat,target_lons,target_lats,wfile=wfile,cache=cache)
+        if cache:
+            self.backends[(name,key)] = backend
+        return backend
+
+    def ocean_mask(self,model_points,target_points):
+        """ 
+        True for target points further than `max_distance` from any model tile.
+        """
+        # Now we need to set the ocean points to NaN because there is no data over ocean in the original dataset!
+        # First, calculate the distance between target grid lon/lat points and original model lon/lat points -
+        print(f'\n• Creating ocean mask for new lat/lon grid')
+        with self.metrics.stage('mask',n=len(target_points),unit='points'):
+            return calc_distances(target_points,model_points,max_distance=self.max_distance)
+
+    def load_weights(self,wfile,key):
+        """ 
+        Weights saved to `wfile` for geometry `key`, or None if there are none.
+        """
+        if not os.path.exists(wfile):
+            return None
+        with np.load(wfile) as f:
+            if str(f['key']) == key:
+                if self.verbose:
+                    print(f'\n• Loading regrid weights from {wfile}')
+                return {k:f[k] for k in ('index','vertices','weights','size')}
+        print(f'!!==> {wfile} was built for a different tile geometry or grid; rebuilding')
+        return None
+
+    def save_weights(self,wfile,key,weights):
+        """ 
+        Saves `weights` for geometry `key` to `wfile`, for later jobs.
+        """
+        print(f'Saving regrid weights to {wfile}')
+        np.savez(wfile,key=key,**weights)
+
+    def weights(self,model_lon,model_lat,target_lons,target_lats,wfile=None,cache=True,batch_size=500000,
+            tri=None,near=None):
+        """ 
+        Builds (or fetches from cache) sparse linear-interpolation weights from the
+        model tiles to the target grid: for every target point that isn't masked,
+        the 3 tiles of the enclosing Delaunay triangle and their barycentric weights.
+        This is exactly what griddata(method='linear') computes internally, but done once.
+        Weights are kept on the instance (unless `cache` is off) and, if `wfile`
+        is set, saved to/loaded from disk so separate jobs can share them.
+        `tri` is an existing triangulation of the tiles to use, and `near` the
+        tiles that can be within `max_distance` of the target points (all by default).
+        """
+        from scipy.spatial import Delaunay
+
+        key = geometry_key(model_lon,model_lat,target_lons,target_lats)+self.precision
+        if key in self.cache:
+            return self.cache[key]
+
+        weights = self.load_weights(wfile,key) if wfile else None
+        if weights is not None:
+            if cache:
+                self.cache[key] = weights
+            return weights
+
+        lon_grid,lat_grid = np.meshgrid(target_lons,target_lats)    # 2D lat/lon matrix
+        model_points = np.column_stack((model_lon,model_lat)) # list of [lon,lat] pairs from model data
+        target_points = np.column_stack((lon_grid.ravel(),lat_grid.ravel()))    # list of [lon,lat] pairs from target grid
+        del lon_grid,lat_grid
+
+        ocean_mask = self.ocean_mask(model_points if near is None else model_points[near],target_points)
+
+        with self.metrics.stage('weights',n=len(target_points),unit='points'):
+            weights_start = time.time()
+            if tri is None:
+                print(f'\n• Triangulating {len(model_points):,} model points')
+                tri = Delaunay(model_points)
+
+            # Only points that are on land *and* inside the triangulation get weights
+            index = np.flatnonzero(~ocean_mask)
+            simplex = np.empty(len(index),dtype=np.int64)
+            for i in range(0,len(index),batch_size):
+                simplex[i:i+batch_size] = tri.find_simplex(target_points[index[i:i+batch_size]])
+            index,simplex = index[simplex>=0],simplex[simplex>=0]
+
+            # Barycentric coordinates from the triangulation's affine transforms
+            # (qhull always works in float64; only the stored weights are cast)
+            vertices = tri.simplices[simplex].astype(np.int32)
+            bary = np.empty((len(index),3),dtype=self.precision)
+            for i in range(0,len(index),batch_size):
+                T = tri.transform[simplex[i:i+batch_size]]
+                b = np.einsum('ijk,ik->ij',T[:,:2],target_points[index[i:i+batch_size]]-T[:,2])
+                bary[i:i+batch_size,:2] = b
+                bary[i:i+batch_size,2] = 1-b.sum(axis=1)
+
+            weights = {'index':index,'vertices':vertices,'weights':bary,'size':np.array(len(target_points))}
+        print(f'⧖ Building regrid weights took {time.time()-weights_start:.2f} seconds')
+
+        if cache:
+            self.cache[key] = weights
+        if wfile:
+            self.save_weights(wfile,key,weights)
+
+        return weights
+
+
+def run_files(config):
+    """
+    Number of monthly files a run of `config` regrids (months x years x members),
+    all on the same tiles.
+    """
+    if not config.years:
+        return 1
+    months = (config.years[1]-config.years[0]+1)*(config.months[1]-config.months[0]+1)
+    return max(1,months*len(config.members or [None]))
+
+
+def geometry_key(model_lon,model_lat,target_lons,target_lats):
+    """ 
+    Short hash identifying a (tile geometry, target grid) pair,
+    used to decide whether cached weights can be reused.
+    """
+    h = hashlib.sha1()
+    for a in (model_lon,model_lat,target_lons,target_lats):
+        h.update(np.ascontiguousarray(a,dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def apply_weights(weights,values):
+    """ 
+    Interpolates a 1D array of tile values with weights from `Regridder.weights()`.
+    Masked target points come back as NaN.
+    """
+    out = np.full(int(weights['size']),np.nan,dtype=weights['weights'].dtype)
+    out[weights['index']] = np.einsum('ij,ij->i',values[weights['vertices']],weights['weights'])
+    return out
+
+
+def calc_distances(target_points,model_points,batch_size=10000,max_distance=0.1):
+    """ 
+    Uses batch processing and a k-d tree
+    to calculate Euclidean distances between data points
+    and return a mask for points further apart than 
+    the specified `max_distance`.
+    See comments for detailed walk-through.
+    """
+    from scipy.spatial import cKDTree
+    from tqdm import tqdm
+
+    print('Calculating distances between regridded points and original points...')
+    # Our dataset is too big to calculate distances between ALL points
+    # using some method like scipy.spatial.distance.cdist,
+    # so we need to take a more memory-efficient approach.
+    #
+    # First, we'll process the data in batches (the loop).
+    #
+    # We'll also use a k-d tree to find nearest neighbors only. Wikipedia: https://en.wikipedia.org/wiki/K-d_tree
+    # "The tree doesn't know or care what units you're using - it just performs Euclidean distance calculations on
+    # the raw numbers you provide."
+    # Euclidean distance calculations assume that you're measuring by laying a ruler on a flat plane, basically.
+    # This is an acceptable estimation in our case because we're working with fine enough spatial resolution.
+
+    # We build a tree from our model points:
+    tree = cKDTree(model_points)
+
+    # And we initialize a mask to identify points too far from the original
+    distance_mask = np.zeros(len(target_points),dtype=bool)
+
+    total_start = time.time()
+    with tqdm(total=len(target_points), desc="Processing points", unit="points") as pbar:
+        for i in range(0,len(target_points),batch_size):
+            batch_start = time.time()
+            end_index = min(i+batch_size,len(target_points))
+
+            # To find the distance to the nearest model point (k=1) for each target gridpoint:
+            distances, indices = tree.query(target_points[i:end_index],k=1)
+
+            # Now we can say which points from the target grid should not be filled in by model data
+            # because they're too far away from any of the original data.
+            # We can apply this as a mask to our gridded values!
+            distance_mask[i:end_index] = distances > max_distance
+
+            batch_time = time.time() - batch_start
+            # tqdm package and the lines below produce a progress bar
+            # to indicate how far we are through this loop and report some timing details
+            pbar.update(end_index-i)
+            pbar.set_postfix({
+                'batch_time':f'{batch_time:.2f}s',
+                'rate':f'{(end_index-i)/batch_time:,.0f} pts/sec'
+
+            })
+
+    total_time = time.time()-total_start
+    print(f'⧖ Total time for batch processing k-d tree distances: {total_time:.2f} seconds')
+
+    return distance_mask
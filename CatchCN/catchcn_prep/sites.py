@@ -0,0 +1,84 @@
+"""
+Site (point) extraction straight from the native tiles, for site-level benchmarks.
+"""
+import csv
+
+import numpy as np
+
+from .regrid import geometry_key
+
+
+def read_sites(fname):
+    """ 
+    Reads a CSV of sites with (at least) `site`, `lon` and `lat` columns.
+    """
+    names,lons,lats = [],[],[]
+    with open(fname,newline='') as f:
+        reader = csv.DictReader(f)
+        columns = {k.strip().lower() for k in reader.fieldnames or []}
+        missing = [k for k in ('site','lon','lat') if k not in columns]
+        if missing:
+            raise ValueError(f'{fname} is missing the {", ".join(missing)} column(s); '
+                'site files need site, lon and lat columns')
+        for row in reader:
+            row = {k.strip().lower():v.strip() for k,v in row.items()}
+            names.append(row['site'])
+            lons.append(float(row['lon']))
+            lats.append(float(row['lat']))
+    return {'site':np.array(names),'lon':np.array(lons),'lat':np.array(lats)}
+
+
+def resolve_sites(model_lon,model_lat,sites,method='nearest',k=4,max_distance=0.1,cache=None):
+    """ 
+    Finds the tile(s) feeding each site, once per tile geometry.
+    'nearest' uses the single nearest tile, 'idw' the `k` nearest tiles
+    weighted by inverse distance. Tiles further than `max_distance` degrees
+    from a site (the same cutoff as the regrid ocean mask) get no weight, so
+    a site with no tile that close gets no tiles at all.
+    Returns the unique tiles to read, for each site the positions of its tiles
+    in that list and their weights, and the distance to the nearest tile.
+    Pass the same `cache` dict on every call to resolve each geometry only once.
+    """
+    from scipy.spatial import cKDTree
+
+    cache = {} if cache is None else cache
+    key = geometry_key(model_lon,model_lat,sites['lon'],sites['lat'])+f'{method}{max_distance}'
+    if key in cache:
+        return cache[key]
+
+    tree = cKDTree(np.column_stack((model_lon,model_lat)))
+    k = 1 if method == 'nearest' else k
+    dist,idx = tree.query(np.column_stack((sites['lon'],sites['lat'])),k=k)
+    dist,idx = dist.reshape(len(idx),k),idx.reshape(len(idx),k)
+
+    if method == 'nearest':
+        w = np.ones(dist.shape)
+    else:
+        # An exact hit takes all the weight
+        with np.errstate(divide='ignore'):
+            w = 1/dist
+        exact = np.isinf(w).any(axis=1)
+        w[exact] = np.isinf(w[exact])
+    # Every tile further than max_distance is left out, not just the nearest,
+    # before the weights are normalised
+    w[dist > max_distance] = 0
+    wsum = w.sum(axis=1,keepdims=True)
+    w = np.divide(w,wsum,out=np.zeros(w.shape),where=wsum>0)
+
+    tiles,pos = np.unique(idx,return_inverse=True)
+    res = {'tiles':tiles,'pos':pos.reshape(idx.shape),'weights':w,'distance':dist[:,0]}
+    cache[key] = res
+    return res
+
+
+def sample_sites(values,res):
+    """ 
+    Combines the values of the selected tiles into one value per site.
+    Missing tiles are dropped and the remaining weights renormalised;
+    sites with nothing left are NaN.
+    """
+    x = values[res['pos']]
+    w = np.where(np.isfinite(x),res['weights'].astype(x.dtype),0)
+    wsum = w.sum(axis=1)
+    return np.divide((w*np.where(np.isfinite(x),x,0)).sum(axis=1),wsum,
+        out=np.full(len(wsum),np.nan,dtype=x.dtype),where=wsum>0)
@@ -0,0 +1,260 @@
+"""
+Spot-check plots for regrid QA: native tiles next to the regridded field for a
+lat/lon box, for every month and variable in one go.
+
+Tiles are binned into a raster image (a mean per pixel, with np.bincount)
+rather than scatter-plotted, and both the tiles and the target grid are cropped
+to the box before regridding, so each panel costs a small fraction of a
+full-globe regrid. The tile geometry doesn't change between months, so the crop
+and the regrid weights are worked out once and reused.
+
+    python -m catchcn_prep.spotcheck --indir .../cat/ens0000/ --filetype lnd_Nt.monthly \\
+        --years 2006 2015 --variables npp gpp lai \\
+        --latrange 4.1 14.6 --lonrange 113.1 128.4 --plotdir spot_check/
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import xarray as xr
+
+from .config import BACKENDS, Config
+from .pipeline import Pipeline
+from .variables import variable_preprocessing
+
+
+def rasterize(lon,lat,values,lonrange,latrange,pixel):
+    """
+    Mean of `values` in each `pixel`-degree cell of the lonrange x latrange box
+    (NaN where there are no tiles). Returns the (lat,lon) image with row 0 at
+    the southern edge.
+    """
+    nlon = max(1,int(np.ceil((lonrange[1]-lonrange[0])/pixel)))
+    nlat = max(1,int(np.ceil((latrange[1]-latrange[0])/pixel)))
+    ix = np.floor((lon-lonrange[0])/pixel).astype(np.int64)
+    iy = np.floor((lat-latrange[0])/pixel).astype(np.int64)
+    keep = (ix >= 0) & (ix < nlon) & (iy >= 0) & (iy < nlat) & np.isfinite(values)
+    idx = iy[keep]*nlon+ix[keep]
+
+    sums = np.bincount(idx,weights=values[keep],minlength=nlat*nlon)
+    counts = np.bincount(idx,minlength=nlat*nlon)
+    image = np.divide(sums,counts,out=np.full(nlat*nlon,np.nan),where=counts>0)
+    return image.reshape(nlat,nlon)
+
+
+def tile_spacing(lon,lat,decimals=4):
+    """
+    Typical spacing (degrees) of the tile rows or columns, whichever is wider:
+    the median step between the distinct tile longitudes and latitudes.
+    """
+    steps = [np.diff(np.unique(np.round(x.astype(np.float64),decimals))) for x in (lon,lat)]
+    steps = [float(np.median(s)) for s in steps if len(s)]
+    return max(steps) if steps else None
+
+
+def crop_tiles(model_lon,model_lat,lonrange,latrange,halo=1.0):
+    """
+    Indices of the tiles inside the box plus a `halo` (degrees), enough for
+    the regrid along the edges of the box to match the full-globe regrid.
+    """
+    return np.flatnonzero(
+        (model_lon >= lonrange[0]-halo) & (model_lon <= lonrange[1]+halo) &
+        (model_lat >= latrange[0]-halo) & (model_lat <= latrange[1]+halo)
+    )
+
+
+def crop_grid(regridder,lonrange,latrange):
+    """
+    The regridder's target latitudes and longitudes inside the box.
+    """
+    target_lats,target_lons = regridder.target_grid(np.float64)
+    target_lats = target_lats[(target_lats >= latrange[0]) & (target_lats <= latrange[1])]
+    target_lons = target_lons[(target_lons >= lonrange[0]) & (target_lons <= lonrange[1])]
+    return target_lats,target_lons
+
+
+def render(native,grid,target_lats,target_lons,lonrange,latrange,title,savename,var='',units='',state=None):
+    """
+    Native raster and regridded field side by side, on one colour scale
+    (2nd-98th percentile of the native values), written to `savename`.
+    Pass the returned `state` back in to redraw the same figure for the next
+    plot instead of building a new one, which is most of the cost of a plot.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    finite = native[np.isfinite(native)]
+    vmin,vmax = np.percentile(finite,[2,98]) if finite.size else (0,1)
+    dlat = target_lats[1]-target_lats[0] if len(target_lats) > 1 else 0
+    dlon = target_lons[1]-target_lons[0] if len(target_lons) > 1 else 0
+    extents = ([*lonrange,*latrange],
+        [target_lons[0]-dlon/2,target_lons[-1]+dlon/2,target_lats[0]-dlat/2,target_lats[-1]+dlat/2])
+
+    if state is None:
+        fig,axes = plt.subplots(1,2,figsize=(12,5),sharex=True,sharey=True,layout='constrained')
+        images = []
+        for ax,image,extent,label in zip(axes,(native,grid),extents,('native tiles','regridded')):
+            images.append(ax.imshow(image,origin='lower',extent=extent,cmap='viridis',interpolation='nearest'))
+            ax.set_title(label)
+            ax.set_xlim(lonrange)
+            ax.set_ylim(latrange)
+            ax.set_xlabel('longitude')
+        axes[0].set_ylabel('latitude')
+        cbar = fig.colorbar(images[1],ax=axes,shrink=0.8)
+        state = {'fig':fig,'images':images,'cbar':cbar}
+
+    for im,image,extent in zip(state['images'],(native,grid),extents):
+        im.set_data(image)
+        im.set_extent(extent)
+        im.set_clim(vmin,vmax)
+    state['cbar'].set_label(f'{var} ({units})' if units else var)
+    state['fig'].suptitle(title)
+    state['fig'].savefig(savename,dpi=120)
+    return state
+
+
+def spot_check(config,variables,lonrange,latrange,plotdir,pixel=None,regridder=None,months=None):
+    """
+    Writes one native-vs-regridded PNG per variable and month in the configured
+    range (only those in `months`, if given) to `plotdir`, and returns a list of
+    (year,month,variable,native mean,regridded mean) for a quick numerical check
+    alongside the pictures. `pixel` defaults to a little over the tile spacing
+    in the box; any finer leaves empty pixels between the tiles.
+    """
+    pipeline = Pipeline(config,regridder=regridder)
+    regridder = pipeline.regridder
+    target_lats,target_lons = crop_grid(regridder,lonrange,latrange)
+    if not len(target_lats) or not len(target_lons):
+        raise ValueError(f'No {regridder.degout} grid points inside {lonrange} x {latrange}')
+    os.makedirs(plotdir,exist_ok=True)
+
+    sub,ntile,summary,state = None,None,[],None
+    start_year,stop_year = config.years
+    start_month,stop_month = config.months
+    for year in range(start_year,stop_year+1,1):
+        for month in range(start_month,stop_month+1,1):
+            if months is not None and month not in months:
+                continue
+            month_start = time.time()
+            infile,_ = pipeline.find_input(config.indir,year,month)
+            with xr.open_dataset(infile,decode_timedelta=True) as raw:
+                tdim = raw['lat'].dims[0]
+                # Work out the crop once; later months only read those tiles
+                if sub is None:
+                    sub = crop_tiles(raw['lon'].values,raw['lat'].values,lonrange,latrange,regridder.band_halo)
+                    ntile = raw.sizes[tdim]
+                    if len(sub) < 3:
+                        raise ValueError(f'Only {len(sub)} tiles inside {lonrange} x {latrange}')
+                    if pixel is None:
+                        spacing = tile_spacing(raw['lon'].values[sub],raw['lat'].values[sub])
+                        pixel = 1.1*spacing if spacing else 0.1
+                    print(f'\n• Spot-checking {len(sub):,} of {ntile:,} tiles in {lonrange} x {latrange} ({pixel:.3f} degree pixels)')
+                elif raw.sizes[tdim] != ntile:
+                    raise ValueError(f'Tile count in {infile} does not match the first file')
+                # Read the span of tiles covering the crop in one contiguous slice
+                # (netCDF point indexing is much slower), then pick the crop out
+                span = raw.isel({tdim:slice(sub[0],sub[-1]+1)})
+                df = variable_preprocessing(span,config.vmap,config.dvmap,config.precision)
+                df = df.isel({tdim:sub-sub[0]})
+
+            model_lon,model_lat = df['lon'].values,df['lat'].values
+            missing = [v for v in variables if v not in df]
+            if missing:
+                raise ValueError(f'Variables {missing} not in {infile}; available: {list(df.data_vars)}')
+            name = regridder.resolve_backend(model_lon,model_lat,target_lons,target_lats,
+                df[variables[0]].values.flatten(),len(variables))
+            backend = regridder.get_backend(name,model_lon,model_lat,target_lons,target_lats)
+
+            for var in variables:
+                values = df[var].values.flatten()
+                native = rasterize(model_lon,model_lat,values,lonrange,latrange,pixel)
+                grid = backend.interpolate(values).reshape(len(target_lats),len(target_lons))
+                savename = f'{plotdir}/CatchCN_spot_check_{var}_{year:0>4}{month:0>2}.png'
+                state = render(native,grid,target_lats,target_lons,lonrange,latrange,
+                    f'CatchCN {var}, {year}-{month:0>2}: native vs {regridder.degout["lon"]}x{regridder.degout["lat"]} deg ({name})',
+                    savename,var=var,units=df[var].attrs.get('units',''),state=state
+                )
+                summary.append((year,month,var,float(np.nanmean(native)),float(np.nanmean(grid))))
+                if config.verbose:
+                    print(f'├ {savename}')
+            print(f'│ ⧖ {year}-{month:0>2}: {len(variables)} plots in {time.time()-month_start:.2f}s')
+
+    if state:
+        import matplotlib.pyplot as plt
+        plt.close(state['fig'])
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Native vs regridded spot-check plots of Catchment-CN output for a lat/lon box.'
+    )
+    parser.add_argument('--indir',type=str,required=True,
+        help='Input directory'
+    )
+    parser.add_argument('--filetype',type=str,default='lnd_Nt.monthly',
+        help='File type, a substring to use when doing a glob search. Default: %(default)s'
+    )
+    parser.add_argument('--years',nargs=2,type=int,required=True,
+        metavar=('Start','End'),
+        help='Start and end years, inclusive.'
+    )
+    parser.add_argument('--months',nargs=2,type=int,default=[1,12],
+        metavar=('Start','End'),
+        help='Start and end months, inclusive. Default: %(default)s'
+    )
+    parser.add_argument('--variables',nargs='+',default=['npp'],
+        help='Variables to plot (CF names, e.g. npp gpp re lai rh ra). Default: %(default)s'
+    )
+    parser.add_argument('--latrange',nargs=2,type=float,required=True,
+        metavar=('South','North')
+    )
+    parser.add_argument('--lonrange',nargs=2,type=float,required=True,
+        metavar=('West','East')
+    )
+    parser.add_argument('--degout',nargs=2,type=float,default=[0.1,0.1],
+        metavar=('Lat','Lon'),
+        help='Output grid spacing in degrees. Default: %(default)s'
+    )
+    parser.add_argument('--pixel',type=float,default=None,
+        help='Pixel size in degrees of the native-tile raster. Finer than the tile spacing leaves '
+            'empty pixels. Default: a little over the tile spacing in the box (about 0.1 for M09)'
+    )
+    parser.add_argument('--regrid_backend',type=str,
+        default='weights',choices=['auto']+BACKENDS,
+        help='Regrid backend, as for preprocess_catchCN_final.py. Default: %(default)s'
+    )
+    parser.add_argument('--plotdir',type=str,required=True,
+        help='Directory to write the PNGs to'
+    )
+    parser.add_argument('-v','--verbose',
+        action='store_true',
+        help='Verbose output'
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = Config(indir=args.indir,filetype=args.filetype,years=tuple(args.years),
+        months=tuple(args.months),degout={'lat':args.degout[0],'lon':args.degout[1]},
+        regrid_backend=args.regrid_backend,verbose=args.verbose
+    )
+    start = time.time()
+    try:
+        summary = spot_check(config,args.variables,args.lonrange,args.latrange,args.plotdir,pixel=args.pixel)
+    except (FileNotFoundError,ValueError) as e:
+        print(f'\n!!==> {e}')
+        sys.exit(1)
+
+    print(f'\n{"month":<9}{"variable":<10}{"native mean":>14}{"regrid mean":>14}')
+    for year,month,var,native,grid in summary:
+        print(f'{year}-{month:0>2}  {var:<10}{native:>14.4e}{grid:>14.4e}')
+    print(f'⧖ {len(summary)} plots in {time.time()-start:.2f} seconds')
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Time coordinates, bounds and calendar encoding (noleap) for ILAMB output.
+"""
+import numpy as np
+
+
+# days in each month of the noleap calendar the output is written in
+NOLEAP_DAYS = [31,28,31,30,31,30,31,31,30,31,30,31]
+
+
+def next_month(year,month):
+    """ 
+    (year,month) of the month after `month`.
+    """
+    return (year+1,1) if month == 12 else (year,month+1)
+
+
+def time_encoding(df,year,month):
+    """ 
+    Adds a time coordinate, time_bounds attribute, and calendar attribute.
+    """
+    import cftime as cf
+
+    # Before we write out we also need to create a time *coordinate*
+    df = df.assign_coords({'time':[cf.DatetimeNoLeap(year, month, 1,0,0,0)]})
+    df['time'].attrs['long_name'] = 'time'
+    df['time'].attrs['cell_methods'] = 'time: minimum'
+    df['time'].encoding['units'] = 'days since 1850-01-01'
+    df['time'].encoding['calendar'] = 'noleap'
+    df['time'].encoding['bounds'] = 'time_bnds'
+    nyear,nmonth = next_month(year,month)
+ 
+    # And define the cell/timestep's *time bounds*
+    tb = np.array(
+        [cf.DatetimeNoLeap(year,month,1,0,0,0),cf.DatetimeNoLeap(nyear,nmonth,1,0,0,0,0)]
+    )
+    df = df.assign({'time_bnds':(('time','nv'),[tb])})
+    df['time_bnds'].attrs['long_name'] = 'time bounds'
+
+    return df
+
+
+def aggregate_time_encoding(df,times,bounds,climatology=False):
+    """ 
+    Adds a time coordinate and bounds to output covering several months.
+    Climatologies get CF `climatology_bnds` in place of `time_bnds`.
+    """
+    bname = 'climatology_bnds' if climatology else 'time_bnds'
+    df = df.assign_coords({'time':times})
+    df['time'].attrs['long_name'] = 'time'
+    if climatology:
+        df['time'].attrs['climatology'] = bname
+    else:
+        df['time'].encoding['bounds'] = bname
+    df['time'].encoding['units'] = 'days since 1850-01-01'
+    df['time'].encoding['calendar'] = 'noleap'
+
+    df = df.assign({bname:(('time','nv'),np.array(bounds))})
+    df[bname].attrs['long_name'] = 'climatology bounds' if climatology else 'time bounds'
+    df[bname].encoding['units'] = 'days since 1850-01-01'
+    df[bname].encoding['calendar'] = 'noleap'
+
+    return df
+
+
+def month_days(df):
+    """ 
+    Length of the time step in days, taken from the noleap `time_bnds`.
+    """
+    tb = df['time_bnds'].values[0]
+    return (tb[1]-tb[0]).days
@@ -0,0 +1,157 @@
+"""
+Variable selection, renaming and derived variables, plus the daily -> monthly
+reduction done in native tile space.
+"""
+import os
+import re
+
+import numpy as np
+import xarray as xr
+
+from .times import NOLEAP_DAYS
+
+
+def variable_preprocessing(df,vmap,dvmap,precision='float64'):
+    """ 
+    Drops variables not used in ILAMB, 
+    renames remaining variables per CF conventions,
+    adds a couple of derived variables for convenience.
+    """ 
+    df = select_variables(df,vmap,precision)
+    df = add_derived_variables(df,dvmap)
+
+    return df
+
+
+def select_variables(df,vmap,precision='float64'):
+    """ 
+    Drops variables not in `vmap`, renames the rest to their CF names
+    and casts them to the working precision.
+    """
+    # Get rid of variables we don't need for ILAMB
+    to_drop = [v for v in df.variables if v not in vmap.keys()]
+    df = df.drop_vars(to_drop)
+
+    # Next, rename relevant variables
+    df = df.rename(vmap)
+
+    # Everything (coordinates included) is computed in the working precision
+    # from here on, so derived variables don't get upcast
+    df = df.astype(precision)
+
+    return df
+
+
+def add_derived_variables(df,dvmap):
+    """ 
+    Adds the derived variables in `dvmap` ('a-b' -> new variable).
+    """
+    for v in dvmap.keys():
+        name = dvmap[v]['name']
+        v1,v2 = v.split('-')
+        df = df.assign({name:(df[v1].dims,df[v1].values-df[v2].values)})
+        df[name].attrs['long_name']=dvmap[v]['long_name']
+        df[name].attrs['units']=dvmap[v]['units']
+
+    return df
+    
+
+def daily_to_monthly_name(infile,year,month):
+    """ 
+    Builds the monthly-file name matching a daily file, e.g.
+    GEOSldas_CN40_9km.tavg24_1d_lnd_Nt.20060101_1200z.nc4 -> GEOSldas_CN40_9km.tavg24_1d_lnd_Nt.monthly.200601.nc4
+    """
+    prefix = '.'.join(os.path.basename(infile).split('.')[:-2])
+    return os.path.join(os.path.dirname(infile),f'{prefix}.monthly.{year:0>4}{month:0>2}.nc4')
+
+
+def daily_date(infile):
+    """ 
+    (year,month,day) from the date stamp of a daily file, e.g.
+    GEOSldas_CN40_9km.tavg24_1d_lnd_Nt.20060101_1200z.nc4 -> (2006,1,1); None if it has none.
+    """
+    stamp = re.search(r'\.(\d{4})(\d{2})(\d{2})_\d{4}z\.',os.path.basename(infile))
+    return tuple(int(x) for x in stamp.groups()) if stamp else None
+
+
+def noleap_days(infiles):
+    """ 
+    The daily files of a month that exist in the noleap calendar of the output,
+    i.e. all but 29 February, and the 29 February files left out.
+    """
+    leap = [f for f in infiles if (daily_date(f) or (0,0,0))[1:] == (2,29)]
+    return [f for f in infiles if f not in leap],leap
+
+
+def reduce_daily(infiles,year,month,vmap,precision='float64',extremes=False,verbose=False,
+        allow_missing_days=False):
+    """ 
+    Streams through the daily files for one month, one file at a time,
+    and reduces the variables in `vmap` to monthly means on the native tiles.
+    Only running sums (and optionally running max/min) are kept,
+    so memory doesn't grow with the number of days.
+    Returns the monthly-mean dataset, laid out like a native monthly file,
+    and a dict of {variable:(max,min)} (empty unless `extremes`).
+    The output is in the noleap calendar, so a month needs one file per noleap
+    day (leave 29 February out, see `noleap_days()`); anything else is an
+    error unless `allow_missing_days`.
+    """
+    ndays = NOLEAP_DAYS[month-1]
+    if len(infiles) != ndays:
+        msg = f'Found {len(infiles)} daily files for {year}-{month:0>2}, expected {ndays} (noleap calendar)'
+        if not allow_missing_days:
+            raise ValueError(msg+'; use --allow_missing_days to average whatever is there')
+        print(f'!!==> {msg}')
+
+    sums,counts,vmax,vmin = {},{},{},{}
+    for i,f in enumerate(infiles):
+        if verbose:
+            print(f'├ Day file ({i+1}/{len(infiles)}): {os.path.basename(f)}')
+        with xr.open_dataset(f,decode_timedelta=True) as day:
+            if i == 0:
+                # Keep the layout (dims, attributes, tile coordinates) of the first day
+                keep = [v for v in vmap.keys() if v in day.variables and v not in ('lat','lon')]
+                layout = {v:(day[v].dims,dict(day[v].attrs)) for v in keep}
+                coords = {v:(day[v].dims,day[v].values,dict(day[v].attrs)) for v in ('lat','lon')}
+            elif day['lat'].size != coords['lat'][1].size:
+                raise ValueError(f'Tile count in {f} does not match the first daily file')
+
+            for v in keep:
+                x = day[v].values
+                valid = np.isfinite(x)
+                if v not in sums:
+                    sums[v] = np.zeros(x.shape,dtype=precision)
+                    counts[v] = np.zeros(x.shape,dtype=np.int32)
+                    if extremes:
+                        vmax[v] = np.full(x.shape,np.nan,dtype=precision)
+                        vmin[v] = np.full(x.shape,np.nan,dtype=precision)
+                sums[v] += np.where(valid,x,0)
+                counts[v] += valid
+                if extremes:
+                    np.fmax(vmax[v],x,out=vmax[v])
+                    np.fmin(vmin[v],x,out=vmin[v])
+
+    df = xr.Dataset(coords)
+    for v in keep:
+        mean = np.divide(sums[v],counts[v],out=np.full(sums[v].shape,np.nan,dtype=precision),where=counts[v]>0)
+        df[v] = (layout[v][0],mean,layout[v][1])
+
+    return df,{v:(vmax[v],vmin[v]) for v in vmax}
+
+
+def add_daily_extremes(df,extremes,vmap):
+    """ 
+    Adds the monthly max/min of the daily values as `<name>_max`/`<name>_min`,
+    using the CF names from `vmap`.
+    """
+    for v,(vmax,vmin) in extremes.items():
+        name = vmap[v]
+        for stat,values in (('max',vmax),('min',vmin)):
+            sname = f'{name}_{stat}'
+            df[sname] = (df[name].dims,values)
+            df[sname].attrs = dict(df[name].attrs)
+            if 'long_name' in df[sname].attrs:
+                df[sname].attrs['long_name'] += f'_daily_{stat}imum'
+            df[sname].attrs['cell_methods'] = f'time: {stat}imum'
+
+    return df
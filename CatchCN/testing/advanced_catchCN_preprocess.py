@@ -4,7 +4,7 @@ import glob
 import os
 import cftime as cf
 from datetime import datetime
-import xesmf as xe
+#import xesmf as xe   # not used yet; regridding lives in catchcn_prep
 #TODO: Think through how to delete/archive old logfiles
 #TODO: Figure out how to append to existing .nc files rather than start from scratch every time
 
@@ -148,10 +148,13 @@ def preprocessing(files,times,time_bounds,drop_vars=None,logfile=None):
             data = xr.concat([data, data_month],dim='time')
         #breakpoint()
 
-    # Finally, make sure lat and lon are set as dimensions for tile
-    # This will make regridding possible later
-    # This step sets lat and lon as a MultiIndex
-    data = data.set_index(tile=['lat','lon'])
+    # Finally, make lat and lon 1D auxiliary coordinates on the tile dimension
+    # (a CF timeSeries layout). This is much cheaper than a lat/lon MultiIndex
+    # over every tile, and can be written straight to netCDF.
+    data = data.set_coords(['lat','lon'])
+    data['lat'].attrs.update({'standard_name':'latitude','units':'degrees_north'})
+    data['lon'].attrs.update({'standard_name':'longitude','units':'degrees_east'})
+    data.attrs['featureType'] = 'timeSeries'
 
     return data
 
@@ -10,7 +10,7 @@ import xesmf as xe
 """
 This script is used to:
 - adjust variable names to match CF conventions
-- add lat and lon as indices, not just as variables
+- add lat and lon as 1D auxiliary coordinates on the tile dimension
 - add a time coordinate
 - remove extraneous variables 
 from original Catchment-CN files (faster I/O smaller files?)
@@ -149,8 +149,12 @@ def main():
                 data[name].attrs['units']=dvmap[v]['units']
                 #breakpoint()
     
-            # Set lat/lon as indices
-            data = data.set_index(tile=['lat','lon'])
+            # Make lat/lon 1D auxiliary coordinates on the tile dimension
+            # (a CF timeSeries layout) instead of a pandas MultiIndex over every tile
+            data = data.set_coords(['lat','lon'])
+            data['lat'].attrs.update({'standard_name':'latitude','units':'degrees_north'})
+            data['lon'].attrs.update({'standard_name':'longitude','units':'degrees_east'})
+            data.attrs['featureType'] = 'timeSeries'
     
             # Before we write out we also need to create a time *coordinate*
             data = data.assign_coords({'time':[cf.DatetimeNoLeap(year, month, 1,0,0,0)]})